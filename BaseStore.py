@@ -0,0 +1,298 @@
+import os
+import threading
+import importlib
+import metrics
+import serializers
+from cache import WriteBehindCache, LRUCache
+
+BACKENDS = {
+    "redis": "RedisStore",
+    "memory": "MemoryStore",
+    "sqlite": "SQLiteStore",
+}
+COUNTED_STATS = ("hits", "misses", "flushes", "evictions")
+parsed_configs = {}
+
+
+def create_store(db_config=None, logger=None, **options):
+    """store of the backend given by 'backend' option of config (redis by default), its module is imported lazily"""
+    backend = "redis"
+    if db_config:
+        backend = BaseStore.parse_config(db_config).get("backend", backend)
+    if backend not in BACKENDS:
+        raise ValueError("Unknown store backend %s, available are: %s" % (backend, ", ".join(sorted(BACKENDS))))
+    module = importlib.import_module(BACKENDS[backend])
+    return getattr(module, BACKENDS[backend])(db_config=db_config, logger=logger, **options)
+
+
+class BaseStore(object):
+    """Write-behind cache of account records and read-through cache of plain values in front of a db.
+    Backends implement access to the db itself:
+        write_records(records) - merges {account: record} into stored records, True on success
+        write_values(values) - writes {key: (encoded value, seconds to live or None)}, True on success
+        get(key) - decoded record of account or None
+        get_value(key), get_values(keys) - encoded value of key or None, list of them in order of keys
+        destroy_store() - removes everything the store has written
+    Optionally increment_counters(deltas, expire) - adds {key: delta} to shared counters, returns their values,
+    backends implementing it set has_counters"""
+    logging = None
+    has_counters = False
+
+    def __init__(self, max_cache_size=1000, max_cache_entries=0, cache_max_age=0, flush_interval=1, max_dirty=10000,
+                 local_cache_entries=10000, local_cache_ttl=60, serializer="marshal", db_config=None, logger=None):
+        if db_config:
+            config_options = self.parse_config(db_config)
+            max_cache_size = int(config_options.get("max_cache_size", max_cache_size))
+            max_cache_entries = int(config_options.get("max_cache_entries", max_cache_entries))
+            cache_max_age = float(config_options.get("cache_max_age", cache_max_age))
+            flush_interval = float(config_options.get("flush_interval", flush_interval))
+            max_dirty = int(config_options.get("max_dirty", max_dirty))
+            local_cache_entries = int(config_options.get("local_cache_entries", local_cache_entries))
+            local_cache_ttl = float(config_options.get("local_cache_ttl", local_cache_ttl))
+            serializer = config_options.get("serializer", serializer)
+
+        if logger:
+            self.logging = logger
+
+        self.cache = WriteBehindCache(max_size=max_cache_size, max_entries=max_cache_entries, max_age=cache_max_age)
+        self.local = LRUCache(max_entries=local_cache_entries, ttl=local_cache_ttl)
+        self.pending_values = {}
+        self.dropped_values = 0
+        self.serializer = serializers.get_serializer(serializer)
+        self.lock = threading.Condition(threading.RLock())
+        self.flush_lock = threading.Lock()
+        self.ready = threading.Event()
+        self.ready.set()
+
+        self.max_dirty = max_dirty
+        self.flush_interval = flush_interval
+        self.flush_requested = threading.Event()
+        self.stopping = threading.Event()
+        self.flusher = None
+        if flush_interval:
+            self.flusher = threading.Thread(target=self.run_flusher, name="StoreFlusher")
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def is_available(self):
+        """False while db is known to be unreachable, then records are only kept in cache"""
+        return True
+
+    @property
+    def max_cache_size(self):
+        return self.cache.max_size
+
+    @max_cache_size.setter
+    def max_cache_size(self, value):
+        self.cache.max_size = value
+
+    def update_cache(self, key, data):
+        """records are merged in write-behind cache which is flushed into db when it's over budget
+        or the oldest not flushed record is older than cache_max_age.
+        With background flusher the caller never writes into db itself, but it waits while there are
+        max_dirty records not flushed yet. While db is unavailable records are only kept in cache"""
+        self.update_cache_many({key: data})
+
+    def update_cache_many(self, records):
+        """same as update_cache for several records, the cache is flushed at most once for all of them"""
+        records = dict((key, data) for key, data in records.iteritems() if key is not None)
+        if not records:
+            return
+        with self.lock:
+            while self.flusher and self.max_dirty and len(self.cache.dirty) >= self.max_dirty \
+                    and self.is_available() and not self.stopping.is_set():
+                self.flush_requested.set()
+                self.lock.wait(self.flush_interval)
+            for key, data in records.iteritems():
+                self.cache.update(key, data)
+            need_flush = self.cache.is_full() or self.cache.has_expired()
+            if not need_flush or not self.is_available():
+                self.cache.evict()
+                return
+        if self.flusher:
+            self.flush_requested.set()
+        else:
+            self.log("Cache if full, it's content is flushed into db")
+            self.flush_cache()
+
+    def flush_cache(self):
+        """writes dirty records of cache into db, they are kept in cache as clean ones until evicted.
+        Flushes are serialized, but cache isn't locked while records are written.
+        Nothing is written until the store is ready"""
+        if not self.ready.is_set():
+            return False
+        with self.flush_lock, metrics.timer("flush"):
+            with self.lock:
+                records, versions = self.cache.take_dirty()
+                values, self.pending_values = self.pending_values, {}
+            if values and self.write_values(values) is not True:
+                with self.lock:
+                    self.queue_values(dict(item for item in values.iteritems() if item[0] not in self.pending_values))
+            if not records:
+                return True
+            if self.write_records(records) is not True:
+                return False
+            with self.lock:
+                self.cache.mark_clean(versions)
+                self.cache.evict()
+                self.lock.notify_all()
+            return True
+
+    def run_flusher(self):
+        """drains dirty records every flush_interval seconds or as soon as cache asks for flush"""
+        while not self.stopping.is_set():
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            try:
+                self.flush_cache()
+            except Exception as e:
+                self.log("Background flush failed: %s" % e)
+
+    def close(self):
+        """stops background flusher and writes everything left in cache"""
+        self.stopping.set()
+        self.flush_requested.set()
+        if self.flusher:
+            self.flusher.join()
+            self.flusher = None
+        with self.lock:
+            self.lock.notify_all()
+        return self.flush_cache()
+
+    def update_db(self, **records):
+        """either writes given records in db or flushes dirty records of cache"""
+        if not records:
+            return self.flush_cache()
+        return self.write_records(records)
+
+    def write_records(self, records):
+        raise NotImplementedError
+
+    def write_values(self, values):
+        raise NotImplementedError
+
+    def cached_get(self, key):
+        """read-through lookup of plain value: local LRU, then db. None is returned on miss or if db is down.
+        Values read from db are kept in local LRU for local_cache_ttl seconds, so changes of other processes are seen"""
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        raw = self.get_value(key)
+        if raw is None:
+            return
+        value = serializers.loads(raw)
+        self.local.set(key, value)
+        return value
+
+    def cached_get_many(self, keys):
+        """read-through lookup of several values, only keys missed in local LRU are read from db at once.
+        Missing keys are absent in returned dictionary"""
+        found = {}
+        misses = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                misses.append(key)
+            else:
+                found[key] = value
+        if not misses:
+            return found
+        for key, raw in zip(misses, self.get_values(misses) or ()):
+            if raw is not None:
+                found[key] = serializers.loads(raw)
+                self.local.set(key, found[key])
+        return found
+
+    def cached_set(self, key, value, expire=None):
+        """value is available from local LRU at once and is written into db with the next flush"""
+        self.local.set(key, value, expire)
+        raw = self.serializer.dumps(value)
+        if self.flusher or not self.ready.is_set():
+            with self.lock:
+                self.queue_values({key: (raw, expire)})
+            return
+        self.write_values({key: (raw, expire)})
+
+    def queue_values(self, values):
+        """Values wait for flush under the lock. Unlike records they're only a cache, so while max_dirty of them
+        wait (e.g. db is unavailable) values of new keys are dropped"""
+        for key, value in values.iteritems():
+            if key in self.pending_values or not self.max_dirty or len(self.pending_values) < self.max_dirty:
+                self.pending_values[key] = value
+            else:
+                self.dropped_values += 1
+
+    def get_value(self, key):
+        raise NotImplementedError
+
+    def get_values(self, keys):
+        raise NotImplementedError
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def destroy_store(self):
+        raise NotImplementedError
+
+    def increment_counters(self, deltas, expire=None):
+        raise NotImplementedError
+
+    def get_cache(self):
+        return self.cache
+
+    def get_cache_size(self):
+        return self.cache.size
+
+    def cache_get(self, key):
+        return self.cache.get(key)
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def local_cache_stats(self):
+        return self.local.stats()
+
+    def stats(self):
+        """numbers of the store exported by /metrics, ever growing ones end with _total"""
+        stats = {"pending_values": len(self.pending_values), "dropped_values_total": self.dropped_values}
+        for prefix, cache_stats in (("cache", self.cache.stats()), ("local_cache", self.local.stats())):
+            for name, value in cache_stats.iteritems():
+                stats["%s_%s%s" % (prefix, name, "_total" if name in COUNTED_STATS else "")] = value
+        return stats
+
+    @staticmethod
+    def convert_str_to_dict(string):
+        """any tagged codec is accepted as well as untagged python literal of old records"""
+        return serializers.loads(string)
+
+    @staticmethod
+    def to_bool(value):
+        return value.strip().lower() in ("true", "1", "yes")
+
+    @staticmethod
+    def parse_config(config):
+        """config is expected to have 'option=value' format, value could be quoted. Parsed file is cached until it's modified,
+        so the store, its backend and the cache don't read it again"""
+        modified = os.path.getmtime(config)
+        parsed = parsed_configs.get(config)
+        if parsed is None or parsed[0] != modified:
+            config_parameters = {}
+            options = BaseStore.read_config(config)
+            for option in options:
+                option_name, option_value = option.split("=", 1)
+                if len(option_value) > 1 and option_value[0] == option_value[-1] and option_value[0] in "'\"":
+                    option_value = option_value[1:-1]
+                config_parameters[option_name.strip()] = option_value
+            parsed = parsed_configs[config] = (modified, config_parameters)
+        return dict(parsed[1])
+
+    @staticmethod
+    def read_config(config):
+        with open(config, 'r') as f:
+            options = f.readlines()
+        f.close()
+        return [x.strip() for x in options]
+
+    def log(self, message):
+        if self.logging:
+            self.logging.info(message)
@@ -0,0 +1,88 @@
+import time
+import threading
+import serializers
+from BaseStore import BaseStore
+
+
+class MemoryStore(BaseStore):
+    """Records and values are kept in dictionaries of the process itself, so there is no network hop at all.
+    Keys are spread over shards each guarded by its own lock, writers of different accounts rarely wait
+    for each other. Data isn't shared between processes and is lost on exit, startup option is ignored"""
+
+    def __init__(self, shards=16, startup=None, db_config=None, logger=None, **store_options):
+        if db_config:
+            shards = int(self.parse_config(db_config).get("shards", shards))
+        if shards < 1:
+            raise ValueError("shards should be a positive number")
+        self.shards = [({}, {}, threading.Lock()) for _ in range(shards)]
+        BaseStore.__init__(self, db_config=db_config, logger=logger, **store_options)
+
+    def shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def group_by_shard(self, keys):
+        """list of (shard, its keys) pairs"""
+        groups = {}
+        for key in keys:
+            groups.setdefault(hash(key) % len(self.shards), []).append(key)
+        return [(self.shards[index], shard_keys) for index, shard_keys in groups.iteritems()]
+
+    def write_records(self, records):
+        """records are kept encoded, so callers never share mutable values with the store"""
+        for (stored, _, lock), keys in self.group_by_shard(records):
+            with lock:
+                for key in keys:
+                    record = serializers.loads(stored[key]) if key in stored else {}
+                    record.update(records[key])
+                    stored[key] = self.serializer.dumps(record)
+        self.log("Database is updated")
+        return True
+
+    def write_values(self, values):
+        now = time.time()
+        for (_, stored, lock), keys in self.group_by_shard(values):
+            with lock:
+                for key in keys:
+                    raw, expire = values[key]
+                    stored[key] = (raw, now + expire if expire else 0)
+        return True
+
+    def get(self, key):
+        stored, _, lock = self.shard(key)
+        with lock:
+            raw = stored.get(key)
+        if raw is None:
+            return
+        return self.convert_str_to_dict(raw)
+
+    def get_value(self, key):
+        _, stored, lock = self.shard(key)
+        with lock:
+            return self.read_value(stored, key, time.time())
+
+    def get_values(self, keys):
+        now = time.time()
+        found = {}
+        for (_, stored, lock), shard_keys in self.group_by_shard(keys):
+            with lock:
+                for key in shard_keys:
+                    found[key] = self.read_value(stored, key, now)
+        return [found[key] for key in keys]
+
+    @staticmethod
+    def read_value(stored, key, now):
+        """expired values are dropped when they are read"""
+        entry = stored.get(key)
+        if entry is None:
+            return
+        raw, expires_at = entry
+        if expires_at and expires_at <= now:
+            del stored[key]
+            return
+        return raw
+
+    def destroy_store(self):
+        for records, values, lock in self.shards:
+            with lock:
+                records.clear()
+                values.clear()
@@ -1,137 +1,536 @@
 import redis
-import ast
-import sys
+import time
+import functools
+import threading
+import metrics
+import serializers
+from BaseStore import BaseStore
+from hashring import HashRing
+
+STARTUP_MODES = ("keep", "reset")
+CONNECTION_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+WATCH_RETRIES = 5
+connection_pools = {}
+connection_pools_lock = threading.Lock()
 
 
 def check_availability(call_redis):
-    """wrapper to decorate db operations with attempts to reconnect and death in case of failure"""
+    """wrapper to decorate db operations with retries with exponential backoff.
+    Operation failed all the retries opens circuit breaker, while it's open db isn't called at all.
+    None is returned in case of failure. Other errors (e.g. of redis commands or of decoding) are raised as they are,
+    redis has answered, so they close the breaker, a failed half-open probe isn't left half-open"""
+    @functools.wraps(call_redis)
     def wrapper(self, *args, **kwargs):
-        while self.attempt < self.retries:
+        if not self.breaker.allow():
+            return
+        for attempt in range(self.retries):
             try:
                 function_value = call_redis(self, *args, **kwargs)
-                self.attempt = 0
+                self.breaker.success()
                 return function_value
-            except redis.exceptions.ConnectionError:
-                self.attempt += 1
-                self.log("Redis connection failed, attempt to reconnect ")
-                if self.attempt > self.retries:
-                    self.log("Redis is unavailable - stop using it")
-                    return wrapper
-                continue
+            except CONNECTION_ERRORS:
+                self.log("Redis connection failed, attempt to reconnect")
+                metrics.increment("redis_failed_attempts_total")
+                if attempt + 1 < self.retries:
+                    time.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+            except Exception:
+                self.breaker.success()
+                raise
+        if self.breaker.failure():
+            self.log("Redis is unavailable - stop using it for %s seconds" % self.breaker.reset_timeout)
+            metrics.increment("redis_circuit_opened_total")
     return wrapper
 
 
-class RedisStore:
-    """Record format in redis: { account : {score: value, nclient1: [interests], nclient2: [interests]}}"""
-    cache = {}
-    attempt = 0
-    logging = None
-    
-    def __init__(self, host='localhost', port=6379, db=0, max_cache_size=1000, retry_on_timeout=True,
-                 socket_timeout=5, socket_keepalive=True, retries=3, db_config=None, logger=None):
+def get_connection_pool(**connection_kwargs):
+    """pools are shared by stores of the same process connected to the same redis"""
+    key = tuple(sorted(connection_kwargs.items()))
+    with connection_pools_lock:
+        if key not in connection_pools:
+            connection_pools[key] = redis.BlockingConnectionPool(**connection_kwargs)
+        return connection_pools[key]
+
+
+class CircuitBreaker(object):
+    """Closed breaker lets all calls through, it's opened after failure_threshold failures in a row.
+    After reset_timeout open breaker lets one probe call through (half-open state): success closes it,
+    failure opens it again for twice longer timeout, but not longer than max_reset_timeout"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=1, reset_timeout=1, max_reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.initial_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self.lock:
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.reset_timeout = self.initial_reset_timeout
+
+    def failure(self):
+        """returns True if the breaker is opened by this failure"""
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            elif self.failures < self.failure_threshold or self.state == self.OPEN:
+                return False
+            self.state = self.OPEN
+            self.opened_at = time.time()
+            return True
+
+
+CIRCUIT_STATES = (CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN)
+
+
+class RedisStore(BaseStore):
+    """Record format in redis: { account : {score: value, nclient1: [interests], nclient2: [interests]}}
+    Records are either stored as one encoded string per account or as a redis hash with encoded field per key.
+    With nodes option ("host:port:db,host:port:db") keys are sharded over several redis by consistent hashing.
+    Options of cache are passed to BaseStore"""
+
+    def __init__(self, host='localhost', port=6379, db=0, retry_on_timeout=True, socket_timeout=5,
+                 socket_keepalive=True, retries=3, record_format="string", max_connections=50, pool_timeout=5,
+                 backoff=0.05, max_backoff=1, breaker_threshold=1, breaker_reset_timeout=1,
+                 breaker_max_reset_timeout=30, key_prefix="scoring:v1:", startup=None, nodes=None, db_config=None,
+                 logger=None, **store_options):
         if db_config:
             config_options = self.parse_config(db_config)
             host = config_options["host"]
             port = int(config_options["port"])
             db = int(config_options["db"])
-            max_cache_size = int(config_options["max_cache_size"])
-            retry_on_timeout = bool(config_options["retry_on_timeout"])
+            retry_on_timeout = self.to_bool(config_options["retry_on_timeout"])
             socket_timeout = int(config_options["socket_timeout"])
-            socket_keepalive = bool(config_options["socket_keepalive"])
+            socket_keepalive = self.to_bool(config_options["socket_keepalive"])
             retries = int(config_options["retries"])
+            record_format = config_options.get("record_format", record_format)
+            max_connections = int(config_options.get("max_connections", max_connections))
+            pool_timeout = float(config_options.get("pool_timeout", pool_timeout))
+            backoff = float(config_options.get("backoff", backoff))
+            max_backoff = float(config_options.get("max_backoff", max_backoff))
+            breaker_threshold = int(config_options.get("breaker_threshold", breaker_threshold))
+            breaker_reset_timeout = float(config_options.get("breaker_reset_timeout", breaker_reset_timeout))
+            breaker_max_reset_timeout = float(config_options.get("breaker_max_reset_timeout",
+                                                                 breaker_max_reset_timeout))
+            key_prefix = config_options.get("key_prefix", key_prefix)
+            startup = startup or config_options.get("startup")
+            nodes = config_options.get("nodes", nodes)
 
-        self.db = redis.Redis(host=host, port=port, db=db, retry_on_timeout=retry_on_timeout,
-                              socket_timeout=socket_timeout, socket_keepalive=socket_keepalive)
+        self.connection_options = dict(retry_on_timeout=retry_on_timeout, socket_timeout=socket_timeout,
+                                       socket_keepalive=socket_keepalive, max_connections=max_connections,
+                                       timeout=pool_timeout)
+        if isinstance(nodes, basestring):
+            nodes = [node.strip() for node in nodes.split(",") if node.strip()]
+        nodes = nodes or ["%s:%s:%s" % (host, port, db)]
+        self.nodes = {}
+        self.ring = HashRing()
+        for node in nodes:
+            self.nodes[node] = self.connect(node)
+            self.ring.add_node(node)
+        self.db = self.nodes[nodes[0]]
+        self.breaker = CircuitBreaker(failure_threshold=breaker_threshold, reset_timeout=breaker_reset_timeout,
+                                      max_reset_timeout=breaker_max_reset_timeout)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retries = retries
+        if record_format not in ("string", "hash"):
+            raise ValueError("record_format should be either string or hash")
+        self.record_format = record_format
+        self.key_prefix = key_prefix
 
-        if logger:
-            self.logging = logger
+        startup = startup or "keep"
+        if startup not in STARTUP_MODES:
+            raise ValueError("startup should be one of: %s" % ", ".join(STARTUP_MODES))
+        BaseStore.__init__(self, db_config=db_config, logger=logger, **store_options)
+        self.resetter = None
+        if startup == "reset":
+            self.ready.clear()
+            self.resetter = threading.Thread(target=self.reset_store, name="RedisStoreReset")
+            self.resetter.daemon = True
+            self.resetter.start()
 
-        self.max_cache_size = max_cache_size
-        self.retries = retries
-        self.destroy_store()
+    def is_available(self):
+        return self.breaker.state != CircuitBreaker.OPEN
+
+    def close(self):
+        if self.resetter:
+            self.stopping.set()
+            self.resetter.join()
+            self.resetter = None
+        return BaseStore.close(self)
+
+    def reset_store(self):
+        """Startup reset: store is considered empty and its writes are delayed until keys are deleted.
+        While redis is unavailable the reset is retried with backoff until it succeeds or the store is closed"""
+        self.log("Store reset is started")
+        delay = self.backoff
+        while self.destroy_store() is not True:
+            self.log("Store reset failed, it's retried in %s seconds" % delay)
+            metrics.increment("redis_reset_failures_total")
+            if self.stopping.wait(delay):
+                self.log("Store is closed before its reset, nothing is written")
+                return
+            delay = min(delay * 2, self.max_backoff)
+        self.ready.set()
+        self.log("Store reset is finished")
 
-    def update_cache(self, key, data):
-        """records taking space lesser than max_cache_size are stored in memory cache"""
-        if key not in self.cache:
-            self.cache[key] = data
-        else:
-            updated_data = self.cache[key].copy()
-            updated_data.update(data)
-            self.cache[key] = updated_data
+    def key(self, key):
+        return "%s%s" % (self.key_prefix, key)
 
-            if self.get_cache_size() >= self.max_cache_size and self.attempt <= self.retries:
-                self.logging.info("Cache if full, it's content is flushed into db")
-                self.flush_cache()
+    def connect(self, node):
+        host, port, db = node.rsplit(":", 2)
+        pool = get_connection_pool(host=host, port=int(port), db=int(db), **self.connection_options)
+        return redis.Redis(connection_pool=pool)
 
-    def flush_cache(self):
-        self.update_db()
-        self.cache.clear()
+    def client(self, db_key):
+        """redis holding the key"""
+        if len(self.nodes) == 1:
+            return self.db
+        return self.nodes[self.ring.get_node(db_key)]
+
+    def group_by_client(self, db_keys):
+        """list of (redis, its keys) pairs"""
+        if len(self.nodes) == 1:
+            return [(self.db, list(db_keys))]
+        groups = {}
+        for db_key in db_keys:
+            groups.setdefault(self.ring.get_node(db_key), []).append(db_key)
+        return [(self.nodes[node], node_keys) for node, node_keys in groups.iteritems()]
+
+    def add_node(self, node, batch_size=500):
+        """Adds redis into the ring and moves there keys it owns now, about 1/N of keys of the other nodes.
+        The node is registered at once and keys are moved by rebalance, so if moving fails (None is returned)
+        calling add_node or rebalance again finishes it. Records written to their new node meanwhile are merged
+        with the moved ones, but an update written between the merge and the unlink of the old copy could be lost,
+        so writes are better paused while nodes are added"""
+        if node not in self.nodes:
+            self.nodes[node] = self.connect(node)
+            self.ring.add_node(node)
+        moved = self.rebalance(batch_size)
+        if moved is not None:
+            self.log("Node %s is added, %s keys are moved to it" % (node, moved))
+        return moved
 
     @check_availability
-    def update_db(self, **records):
-        """either writes given records in db or take it from cache"""
-        db_addition = records
-        if not records:
-            db_addition = self.cache
-        for key, data in db_addition.iteritems():
-            if not self.db.get(key):
-                self.db.set(key, data)
+    def rebalance(self, batch_size=500):
+        """moves keys which aren't on their node of the ring there, returns number of moved keys.
+        It could be repeated any time, keys already in place are left as they are"""
+        moved = 0
+        for source_node, source in self.nodes.items():
+            keys = []
+            for db_key in source.scan_iter(match=self.key("*"), count=batch_size):
+                if self.ring.get_node(db_key) != source_node:
+                    keys.append(db_key)
+                if len(keys) >= batch_size:
+                    moved += self.move_misplaced(source, keys)
+                    keys = []
+            if keys:
+                moved += self.move_misplaced(source, keys)
+        return moved
+
+    def move_misplaced(self, source, keys):
+        groups = {}
+        for db_key in keys:
+            groups.setdefault(self.ring.get_node(db_key), []).append(db_key)
+        return sum(self.move_keys(source, self.nodes[node], node_keys) for node, node_keys in groups.iteritems())
+
+    def move_keys(self, source, target, keys):
+        """copies string and hash keys with their time to live and unlinks them from source.
+        Keys the target already has (written there after the ring has changed) are merged, their fields win"""
+        entries = self.read_keys(source, keys)
+        newer = dict((entry[0], entry) for entry in self.read_keys(target, [entry[0] for entry in entries]))
+        merged = []
+        for entry in entries:
+            if entry[0] in newer:
+                entry = self.merge_entries(entry, newer[entry[0]])
+            if entry is not None:
+                merged.append(entry)
+        self.write_keys(target, merged)
+        source.unlink(*keys)
+        return len(keys)
+
+    def merge_entries(self, moved, newer):
+        """entry to write over the newer entry of the same key, None keeps the newer one as it is.
+        Records (dictionaries) are merged field by field, other values of the newer entry are kept"""
+        db_key, key_type, ttl, value = moved
+        if key_type != newer[1]:
+            return
+        if key_type == "hash":
+            fields = dict(value)
+            fields.update(newer[3])
+            return db_key, key_type, newer[2], fields
+        try:
+            record, newer_record = self.convert_str_to_dict(value), self.convert_str_to_dict(newer[3])
+        except Exception:
+            return
+        if isinstance(record, dict) and isinstance(newer_record, dict):
+            record.update(newer_record)
+            return db_key, key_type, newer[2], self.serializer.dumps(record)
+
+    @staticmethod
+    def read_keys(client, keys):
+        """(key, type, milliseconds to live or None, raw value) of string and hash keys, read with two pipelines.
+        Keys of other types and keys deleted meanwhile are skipped"""
+        pipe = client.pipeline(transaction=False)
+        for db_key in keys:
+            pipe.type(db_key)
+            pipe.pttl(db_key)
+        described = pipe.execute()
+        for db_key, key_type in zip(keys, described[::2]):
+            if key_type == "hash":
+                pipe.hgetall(db_key)
             else:
-                updated_data = self.convert_str_to_dict(self.db.get(key)).copy()
-                updated_data.update(data)
-                self.db.set(key, updated_data)
+                pipe.get(db_key)
+        values = pipe.execute()
+        return [(db_key, key_type, ttl if ttl > 0 else None, value)
+                for db_key, key_type, ttl, value in zip(keys, described[::2], described[1::2], values)
+                if key_type in ("string", "hash") and value]
+
+    @staticmethod
+    def write_keys(client, entries):
+        """writes entries of read_keys with one pipeline, existing hashes are replaced rather than merged"""
+        pipe = client.pipeline(transaction=False)
+        for db_key, key_type, ttl, value in entries:
+            if key_type == "hash":
+                pipe.delete(db_key)
+                pipe.hmset(db_key, value)
+                if ttl:
+                    pipe.pexpire(db_key, ttl)
+            else:
+                pipe.set(db_key, value, px=ttl)
+        pipe.execute()
+
+    def export_batches(self, cursor=None, batch_size=500):
+        """Yields (cursor, entries) for every SCAN batch of keys of the store, node after node. Entries are those
+        of read_keys with keys without key_prefix. Cursor ("node/position") is where export continues after the batch,
+        it's None after the last one. Only one batch is held in memory"""
+        nodes = sorted(self.nodes)
+        node, position = cursor.rsplit("/", 1) if cursor else (nodes[0], 0)
+        if node not in self.nodes:
+            raise ValueError("Cursor of unknown node %s" % node)
+        prefix_length = len(self.key_prefix)
+        for index in range(nodes.index(node), len(nodes)):
+            client = self.nodes[nodes[index]]
+            position = int(position)
+            while True:
+                position, keys = client.scan(position, match=self.key("*"), count=batch_size)
+                entries = [(db_key[prefix_length:], key_type, ttl, value)
+                           for db_key, key_type, ttl, value in (self.read_keys(client, keys) if keys else ())]
+                if position:
+                    next_cursor = "%s/%s" % (nodes[index], position)
+                else:
+                    next_cursor = "%s/0" % nodes[index + 1] if index + 1 < len(nodes) else None
+                yield next_cursor, entries
+                if not position:
+                    break
+
+    @check_availability
+    def import_entries(self, entries):
+        """writes exported entries under key_prefix of this store, keys go to their nodes of this store's ring.
+        Returns number of written keys"""
+        db_entries = dict((self.key(key), (self.key(key), key_type, ttl, value))
+                          for key, key_type, ttl, value in entries)
+        for client, db_keys in self.group_by_client(db_entries):
+            self.write_keys(client, [db_entries[db_key] for db_key in db_keys])
+        return len(db_entries)
+
+    @check_availability
+    def write_records(self, records):
+        if self.record_format == "hash":
+            self.update_hashes(records)
+        elif not self.update_strings(records):
+            self.log("Records are changed by other writers, they're left for the next flush")
+            return False
         self.log("Database is updated")
+        return True
 
-    def get_cache(self):
-        return self.cache
+    @check_availability
+    def write_values(self, values):
+        db_values = dict((self.key(key), value) for key, value in values.iteritems())
+        for client, db_keys in self.group_by_client(db_values):
+            pipe = client.pipeline(transaction=False)
+            for db_key in db_keys:
+                raw, expire = db_values[db_key]
+                pipe.set(db_key, raw, ex=expire or None)
+            pipe.execute()
+        return True
 
-    def get_cache_size(self):
-        return sys.getsizeof(self.cache)
+    @check_availability
+    def get_value(self, key):
+        if self.ready.is_set():
+            db_key = self.key(key)
+            return self.client(db_key).get(db_key)
 
-    def cache_get(self, key):
-        if key in self.cache:
-            return self.cache[key]
-        else:
+    @check_availability
+    def get_values(self, keys):
+        """values of keys in the same order, they are read with one MGET per redis"""
+        if not self.ready.is_set():
             return
+        db_keys = [self.key(key) for key in keys]
+        found = {}
+        for client, client_keys in self.group_by_client(db_keys):
+            found.update(zip(client_keys, client.mget(client_keys)))
+        return [found[db_key] for db_key in db_keys]
+
+    has_counters = True
+
+    @check_availability
+    def increment_counters(self, deltas, expire=None):
+        """adds deltas to integer counters (created as 0), returns {key: new value}"""
+        db_deltas = dict((self.key(key), (key, delta)) for key, delta in deltas.iteritems())
+        totals = {}
+        for client, db_keys in self.group_by_client(db_deltas):
+            pipe = client.pipeline(transaction=False)
+            for db_key in db_keys:
+                pipe.incrby(db_key, db_deltas[db_key][1])
+                if expire:
+                    pipe.expire(db_key, expire)
+            values = pipe.execute()[::2 if expire else 1]
+            totals.update((db_deltas[db_key][0], value) for db_key, value in zip(db_keys, values))
+        return totals
+
+    def update_hashes(self, records):
+        """fields are merged by redis itself, so nothing is read back before writing"""
+        db_records = dict((self.key(key), data) for key, data in records.iteritems() if data)
+        for client, db_keys in self.group_by_client(db_records):
+            pipe = client.pipeline(transaction=False)
+            for db_key in db_keys:
+                pipe.hmset(db_key, dict((field, self.serializer.dumps(value))
+                                        for field, value in db_records[db_key].iteritems()))
+            pipe.execute()
+
+    def update_strings(self, records):
+        """All records of a redis are read with one MGET and written back with one MSET, the keys are watched
+        in between so concurrent writers of the same accounts don't lose each other's updates.
+        Write of a redis is tried WATCH_RETRIES times, False is returned if the keys were changed every time"""
+        db_records = dict((self.key(key), data) for key, data in records.iteritems())
+        for client, db_keys in self.group_by_client(db_records):
+            with client.pipeline() as pipe:
+                for _ in range(WATCH_RETRIES):
+                    try:
+                        pipe.watch(*db_keys)
+                        stored = pipe.mget(db_keys)
+                        merged = {}
+                        for db_key, old_value in zip(db_keys, stored):
+                            updated_data = self.convert_str_to_dict(old_value) if old_value else {}
+                            updated_data.update(db_records[db_key])
+                            merged[db_key] = self.serializer.dumps(updated_data)
+                        pipe.multi()
+                        pipe.mset(merged)
+                        pipe.execute()
+                        break
+                    except redis.exceptions.WatchError:
+                        metrics.increment("redis_watch_conflicts_total")
+                else:
+                    return False
+        return True
+
+    def breaker_state(self):
+        return self.breaker.state
+
+    def stats(self):
+        stats = BaseStore.stats(self)
+        stats["circuit_state"] = CIRCUIT_STATES.index(self.breaker.state)
+        stats["circuit_failures"] = self.breaker.failures
+        stats["nodes"] = len(self.nodes)
+        return stats
 
     @check_availability
     def get(self, key):
-        if self.db.get(key):
-            return self.db.get(key)
-        else:
+        """returns decoded record of the account or None"""
+        if not self.ready.is_set():
             return
+        key = self.key(key)
+        client = self.client(key)
+        if self.record_format == "hash":
+            try:
+                fields = client.hgetall(key)
+            except redis.exceptions.ResponseError:
+                fields = None
+            if fields:
+                return self.convert_hash_to_dict(fields)
+        raw = client.get(key)
+        if raw is None:
+            return
+        return self.convert_str_to_dict(raw)
 
     @check_availability
-    def destroy_store(self):
-        for key in self.db.scan_iter("*"):
-            self.db.delete(key)
-
-    @staticmethod
-    def convert_str_to_dict(string):
-        try:
-            return ast.literal_eval(string)
-        except ValueError:
-            raise ValueError("Couldn't transform the string to dictionary")
+    def migrate_records(self, batch_size=500):
+        """rewrites records of previous formats (e.g. python literals) with the configured serializer and format"""
+        migrated = 0
+        for client in self.nodes.values():
+            keys = []
+            for key in client.scan_iter(match=self.key("*"), count=batch_size):
+                keys.append(key)
+                if len(keys) >= batch_size:
+                    migrated += self.migrate_keys(client, keys)
+                    keys = []
+            if keys:
+                migrated += self.migrate_keys(client, keys)
+        self.log("%s records are migrated" % migrated)
+        return migrated
 
-    @staticmethod
-    def parse_config(config):
-        """config is expected to have 'option=value' format"""
-        config_parameters = {}
-        options = RedisStore.read_config(config)
-        for option in options:
-            option_name, option_value = option.split("=")
-            config_parameters[option_name] = option_value
+    def migrate_keys(self, client, keys):
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        types = pipe.execute()
+        string_keys = [key for key, key_type in zip(keys, types) if key_type == "string"]
+        if not string_keys:
+            return 0
+        pipe = client.pipeline(transaction=False)
+        migrated = 0
+        for key, raw in zip(string_keys, client.mget(string_keys)):
+            if raw is None or (self.record_format == "string" and raw[:1] == self.serializer.tag):
+                continue
+            record = self.convert_str_to_dict(raw)
+            if not isinstance(record, dict):
+                continue
+            migrated += 1
+            if self.record_format == "hash":
+                pipe.delete(key)
+                if record:
+                    pipe.hmset(key, dict((field, self.serializer.dumps(value)) for field, value in record.iteritems()))
+            else:
+                pipe.set(key, self.serializer.dumps(record))
+        pipe.execute()
+        return migrated
 
-        return config_parameters
+    @check_availability
+    def destroy_store(self, batch_size=1000):
+        """unlinks all keys of the store namespace in batches, redis frees their memory in background.
+        True on success"""
+        for client in self.nodes.values():
+            keys = []
+            for key in client.scan_iter(match=self.key("*"), count=batch_size):
+                keys.append(key)
+                if len(keys) >= batch_size:
+                    client.unlink(*keys)
+                    keys = []
+            if keys:
+                client.unlink(*keys)
+        return True
 
     @staticmethod
-    def read_config(config):
-        with open(config, 'r') as f:
-            options = f.readlines()
-        f.close()
-        return [x.strip() for x in options]
-    
-    def log(message)
-        if self.logging:
-            self.logging.info(message)
-            
+    def convert_hash_to_dict(fields):
+        return dict((int(field) if field.isdigit() else field, serializers.loads(value))
+                    for field, value in fields.iteritems())
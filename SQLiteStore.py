@@ -0,0 +1,161 @@
+import os
+import time
+import sqlite3
+import threading
+from BaseStore import BaseStore
+
+STARTUP_MODES = ("keep", "reset")
+MAX_VARIABLES = 500
+
+
+def chunks(items, size=MAX_VARIABLES):
+    """sqlite limits number of variables in one statement"""
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class SQLiteStore(BaseStore):
+    """Records and values in one sqlite file on local disk, no server is needed.
+    The file is in WAL mode, so readers don't wait for the writer and every commit appends to the log only.
+    Each thread and each forked worker opens its own connection"""
+
+    def __init__(self, path="scoring.db", synchronous="normal", timeout=30, startup=None, db_config=None,
+                 logger=None, **store_options):
+        if db_config:
+            config_options = self.parse_config(db_config)
+            path = config_options.get("path", path)
+            synchronous = config_options.get("synchronous", synchronous)
+            timeout = float(config_options.get("timeout", timeout))
+            startup = startup or config_options.get("startup")
+
+        self.path = path
+        self.synchronous = synchronous
+        self.timeout = timeout
+        self.local_connection = threading.local()
+        startup = startup or "keep"
+        if startup not in STARTUP_MODES:
+            raise ValueError("startup should be one of: %s" % ", ".join(STARTUP_MODES))
+        with self.transaction() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+            cursor.execute("CREATE TABLE IF NOT EXISTS string_values "
+                           "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS string_values_expires_at ON string_values (expires_at)")
+            cursor.execute("CREATE TABLE IF NOT EXISTS counters "
+                           "(key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires_at REAL)")
+        if startup == "reset":
+            self.destroy_store()
+        BaseStore.__init__(self, db_config=db_config, logger=logger, **store_options)
+
+    def connection(self):
+        """connection of the current thread, connections inherited from the parent process are never reused"""
+        connection = getattr(self.local_connection, "connection", None)
+        if connection is None or self.local_connection.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=%s" % self.synchronous)
+            self.local_connection.connection = connection
+            self.local_connection.pid = os.getpid()
+        return connection
+
+    def transaction(self):
+        return Transaction(self.connection())
+
+    def write_records(self, records):
+        """stored records are read and merged with updates in one write transaction"""
+        try:
+            with self.transaction() as cursor:
+                stored = self.select(cursor, "records", records)
+                cursor.executemany("INSERT OR REPLACE INTO records (key, value) VALUES (?, ?)", [
+                    (key, sqlite3.Binary(self.merge(stored.get(key), data))) for key, data in records.iteritems()
+                ])
+        except sqlite3.OperationalError as e:
+            self.log("Records aren't written: %s" % e)
+            return False
+        self.log("Database is updated")
+        return True
+
+    def merge(self, raw, data):
+        record = self.convert_str_to_dict(raw) if raw else {}
+        record.update(data)
+        return self.serializer.dumps(record)
+
+    def write_values(self, values):
+        """expired values are deleted along with every write"""
+        now = time.time()
+        try:
+            with self.transaction() as cursor:
+                cursor.execute("DELETE FROM string_values WHERE expires_at <= ?", (now,))
+                cursor.executemany("INSERT OR REPLACE INTO string_values (key, value, expires_at) VALUES (?, ?, ?)", [
+                    (key, sqlite3.Binary(raw), now + expire if expire else None)
+                    for key, (raw, expire) in values.iteritems()
+                ])
+        except sqlite3.OperationalError as e:
+            self.log("Values aren't written: %s" % e)
+            return False
+        return True
+
+    @staticmethod
+    def select(cursor, table, keys, now=None):
+        """{key: encoded value} of the keys found in table, they are looked up in chunks"""
+        found = {}
+        for chunk in chunks(set(keys)):
+            query = "SELECT key, value FROM %s WHERE key IN (%s)" % (table, ", ".join("?" * len(chunk)))
+            if now is not None:
+                query += " AND (expires_at IS NULL OR expires_at > %r)" % now
+            for key, value in cursor.execute(query, chunk):
+                found[key] = str(value)
+        return found
+
+    def get(self, key):
+        raw = self.select(self.connection().cursor(), "records", [key]).get(key)
+        if raw is None:
+            return
+        return self.convert_str_to_dict(raw)
+
+    def get_value(self, key):
+        return self.select(self.connection().cursor(), "string_values", [key], time.time()).get(key)
+
+    def get_values(self, keys):
+        found = self.select(self.connection().cursor(), "string_values", keys, time.time())
+        return [found.get(key) for key in keys]
+
+    has_counters = True
+
+    def increment_counters(self, deltas, expire=None):
+        """adds deltas to integer counters (created as 0) in one transaction, returns {key: new value}.
+        Counters are shared by all processes using the file, expire is reset by every increment like in redis"""
+        now = time.time()
+        expires_at = now + expire if expire else None
+        try:
+            with self.transaction() as cursor:
+                cursor.execute("DELETE FROM counters WHERE expires_at <= ?", (now,))
+                cursor.executemany("INSERT OR IGNORE INTO counters (key, value) VALUES (?, 0)",
+                                   [(key,) for key in deltas])
+                cursor.executemany("UPDATE counters SET value = value + ?, expires_at = ? WHERE key = ?",
+                                   [(delta, expires_at, key) for key, delta in deltas.iteritems()])
+                found = self.select(cursor, "counters", deltas)
+        except sqlite3.OperationalError as e:
+            self.log("Counters aren't updated: %s" % e)
+            return
+        return dict((key, int(value)) for key, value in found.iteritems())
+
+    def destroy_store(self):
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM records")
+            cursor.execute("DELETE FROM string_values")
+            cursor.execute("DELETE FROM counters")
+
+
+class Transaction(object):
+    """write transaction taking the lock at once, so concurrent merges of the same records are serialized"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection.cursor()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
@@ -1,32 +1,52 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import time
+STARTED = time.time()
+
 import abc
-import json
+import re
 import datetime
 import logging
 import hashlib
-import uuid
+import hmac
+import zlib
+import os
+import socket
+import signal
+import threading
+import Queue
+import asynclog
+import jsoncodec
+import metrics
 import scoring
-import RedisStore
+import BaseStore
+from cache import LRUCache
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
 ADMIN_SALT = "42"
+ADMIN_SCORE = 42
 OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_ENTITY_TOO_LARGE = 413
 INVALID_REQUEST = 422
+TOO_MANY_REQUESTS = 429
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_ENTITY_TOO_LARGE: "Request Entity Too Large",
     INVALID_REQUEST: "Invalid Request",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
 }
 UNKNOWN = 0
 MALE = 1
@@ -36,9 +56,27 @@ GENDERS = {
     MALE: "male",
     FEMALE: "female",
 }
+SERVING_MODES = ("single", "thread", "prefork")
+MAX_BATCH_SIZE = 1000
+BATCH_WORKERS = 8
+MAX_BODY_SIZE = 1024 * 1024
+STREAM_MIN_ITEMS = 1000
+KEEPALIVE_TIMEOUT = 0
+MAX_KEEPALIVE_REQUESTS = 1000
+GZIP_MIN_SIZE = 0
+GZIP_LEVEL = 6
+RESULT_TTL = 60
+ERROR_TTL = 10
+CACHED_METHODS = ("online_score",)
+MAX_QUEUE = 128
+STARTUP = {}
+DATE_PATTERN = re.compile(r"(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])\.(1[0-2]|0[1-9]|[1-9])\.(\d{4})\Z")
+PHONE_SEPARATORS = re.compile(r"[()\- ]")
 
 
 class Parameter:
+    """Fields implement check(value) returning error message of invalid value or None,
+    it's used as is by compiled validators of request classes"""
     __metaclass__ = abc.ABCMeta
 
     empty_values = (None, (), [], {}, '')
@@ -48,84 +86,144 @@ class Parameter:
         self.nullable = nullable
 
     @abc.abstractmethod
-    def validate(self, value):
+    def check(self, value):
         pass
 
+    def validate(self, value):
+        error = self.check(value)
+        if error:
+            raise ValidationError(error)
+
 
 class ValidationError(Exception):
     pass
 
 
 class CharField(Parameter):
-    def validate(self, value):
+    def check(self, value):
         if not isinstance(value, basestring):
-            raise ValidationError("The value should be a string")
+            return "The value should be a string"
 
 
 class ArgumentsField(Parameter):
-    def validate(self, value):
+    def check(self, value):
         if not isinstance(value, dict):
-            raise ValidationError("The value should consist of pairs key:value separated by comma")
+            return "The value should consist of pairs key:value separated by comma"
 
 
 class EmailField(CharField):
-    def validate(self, value):
-        super(EmailField, self).validate(value)
-        if "@" not in value or value[-1] is "@" or value[0] is "@":
-            raise ValidationError("Entered value is not a valid email")
+    def check(self, value):
+        if not isinstance(value, basestring):
+            return "The value should be a string"
+        if "@" not in value or value[-1] == "@" or value[0] == "@":
+            return "Entered value is not a valid email"
 
 
 class PhoneField(Parameter):
-    def validate(self, value):
-        if not isinstance(value, basestring) and not isinstance(value, int):
-            raise ValidationError("Entered value is not a valid phone number in Russia")
-        elif not str(value).startswith("7"):
-            raise ValidationError("Entered value should start from 7")
-        elif len(str(value).replace('(', '').replace(')', '').replace('-', '').replace(' ', '')) != 11:
-            raise ValidationError("Entered value is not a valid phone number in Russia")
+    def check(self, value):
+        if isinstance(value, (int, long)):
+            value = str(value)
+        elif not isinstance(value, basestring):
+            return "Entered value is not a valid phone number in Russia"
+        if not value.startswith("7"):
+            return "Entered value should start from 7"
+        if len(PHONE_SEPARATORS.sub("", value)) != 11:
+            return "Entered value is not a valid phone number in Russia"
 
 
 class DateField(Parameter):
-    def validate(self, value):
+    def check(self, value):
+        if self.parse(value) is None:
+            return "Incorrect data format, should be DD.MM.YYYY"
+
+    @staticmethod
+    def parse(value):
+        """DD.MM.YYYY string into date or None, strings are accepted as strptime with %d.%m.%Y accepts them"""
+        match = DATE_PATTERN.match(value) if isinstance(value, basestring) else None
+        if not match:
+            return
+        day, month, year = match.groups()
         try:
-            datetime.datetime.strptime(value, '%d.%m.%Y')
+            return datetime.date(int(year), int(month), int(day))
         except ValueError:
-            raise ValidationError("Incorrect data format, should be DD.MM.YYYY")
+            return
 
 
 class BirthDayField(DateField):
-    def validate(self, value):
-        super(BirthDayField, self).validate(value)
-        birth_date = datetime.datetime.strptime(value, '%d.%m.%Y')
-        if datetime.datetime.now().year - birth_date.year > 70:
-            raise ValidationError("Incorrect birth day")
+    def check(self, value):
+        birth_date = self.parse(value)
+        if birth_date is None:
+            return "Incorrect data format, should be DD.MM.YYYY"
+        if datetime.date.today().year - birth_date.year > 70:
+            return "Incorrect birth day"
 
 
 class GenderField(Parameter):
-    def validate(self, value):
+    def check(self, value):
         if value not in GENDERS:
-            raise ValidationError("Gender value should be equal to 0,1 or 2")
+            return "Gender value should be equal to 0,1 or 2"
 
 
 class ClientIDsField(Parameter):
-    def validate(self, values):
+    def check(self, values):
         if not isinstance(values, list):
-            raise ValidationError("Invalid data type, should be an array of digits")
+            return "Invalid data type, should be an array of digits"
         if not all(isinstance(v, int) and v >= 0 for v in values):
-            raise ValidationError("All elements should be digits")
+            return "All elements should be digits"
+
+
+def compile_validator(parameters):
+    """builds one function checking all the parameters of a request class, it fills errors dictionary in place.
+    Falsy values except numbers are the empty ones (see Parameter.empty_values)"""
+    checks = tuple((name, parameter.required, parameter.nullable, parameter.check)
+                   for name, parameter in parameters)
+
+    def validator(values, errors):
+        for name, required, nullable, check in checks:
+            if name not in values:
+                if required:
+                    errors[name] = "Mandatory parameter can't be omitted"
+                continue
+            value = values[name]
+            if not value and not isinstance(value, (int, long, float)):
+                if not nullable:
+                    errors[name] = "The parameter should have a value"
+                continue
+            error = check(value)
+            if error:
+                errors[name] = error
+    return validator
+
+
+def compile_loader(request_class, fields):
+    """builds one function setting the fields of a request from a mapping, absent fields are set to None.
+    Values are set right through slot descriptors of the class"""
+    setters = tuple((name, getattr(request_class, name).__set__) for name in fields)
+
+    def loader(request, values):
+        get = values.get
+        for name, set_field in setters:
+            set_field(request, get(name))
+    return loader
 
 
 class MetaParameters(type):
     """Need to determine possible arguments could be given for http request and their properties via text fields
-    Applied for validation incoming requests"""
+    Applied for validation incoming requests: validator of the class fields is compiled once the class is defined.
+    Fields become slots of the class, so requests have fixed layout without instance dictionary"""
     def __new__(mcs, name, bases, attributes):
         parameters = []
         for parameter_name, parameter in attributes.items():
             if isinstance(parameter, Parameter):
                 parameter._name = parameter_name
                 parameters.append((parameter_name, parameter))
+                del attributes[parameter_name]
+        fields = tuple(parameter_name for parameter_name, _ in parameters)
+        attributes.setdefault("__slots__", fields)
         new_request = super(MetaParameters, mcs).__new__(mcs, name, bases, attributes)
         new_request.parameters = parameters
+        new_request.validator = staticmethod(compile_validator(parameters))
+        new_request.loader = staticmethod(compile_loader(new_request, fields))
         return new_request
 
 
@@ -133,13 +231,22 @@ class BaseRequest(object):
     """General scheme of inheritance: abstract BaseRequest <- MethodRequest
     <- <specific request>(ClientsInterestsRequest/OnlineScoreRequest)"""
     __metaclass__ = MetaParameters
+    __slots__ = ("body", "errors")
 
     def __init__(self, **kwargs):
-        self.base_parameters = []
+        self.load(kwargs)
+
+    @classmethod
+    def from_body(cls, body):
+        """request of parsed JSON body, the body isn't copied into keyword arguments"""
+        request = cls.__new__(cls)
+        request.load(body)
+        return request
+
+    def load(self, body):
+        self.body = body
         self.errors = {}
-        for parameter, value in kwargs.items():
-            setattr(self, parameter, value)
-            self.base_parameters.append(parameter)
+        self.loader(self, body)
 
     @abc.abstractmethod
     def validate_self(self):
@@ -162,24 +269,22 @@ class MethodRequest(BaseRequest):
     def is_admin(self):
         return self.login == ADMIN_LOGIN
 
-    def validate_self(self):
-        for name, parameter in self.parameters:
-            if name not in self.base_parameters:
-                if name not in self.arguments and parameter.required:
-                    self.errors[name] = "Mandatory parameter can't be omitted"
-                    continue
-
-            if name not in self.arguments:
-                continue
-
-            value = self.arguments[name]
-            if value in parameter.empty_values and name is not parameter.nullable:
-                self.errors[name] = "The parameter should have a value"
+    def load(self, body):
+        """fields of MethodRequest are set from the body, fields of specific request - from its arguments"""
+        self.body = body
+        self.errors = {}
+        MethodRequest.loader(self, body)
+        if self.loader is not MethodRequest.loader:
+            self.loader(self, self.arguments if isinstance(self.arguments, dict) else {})
 
-            try:
-                parameter.validate(value)
-            except ValidationError as e:
-                self.errors[name] = e.message
+    def validate_self(self):
+        """fields of MethodRequest are checked in request body, fields of specific request - in its arguments"""
+        MethodRequest.validator(self.body, self.errors)
+        if "arguments" in self.errors:
+            return
+        self.arguments = self.arguments or {}
+        if self.validator is not MethodRequest.validator:
+            self.validator(self.arguments, self.errors)
 
     def handle(self, *request_args):
         pass
@@ -191,13 +296,9 @@ class ClientsInterestsRequest(MethodRequest):
 
     __choices = ["books", "tv", "music", "it", "travel", "pets"]
 
-    def handle(self, context):
-        self.validate_self()
-        if self.errors:
-            return self.errors, INVALID_REQUEST
-
-        resp_body = {cid: scoring.get_interests(store=context, cid=cid) for cid in self.arguments["client_ids"]}
-        context["nclients"] = len(self.arguments["client_ids"])
+    def handle(self, context, store=None):
+        resp_body = scoring.get_interests_many(store=store, cids=self.client_ids)
+        context["nclients"] = len(self.client_ids)
         return resp_body, OK
 
 
@@ -209,135 +310,702 @@ class OnlineScoreRequest(MethodRequest):
     birthday = BirthDayField(required=False, nullable=True)
     gender = GenderField(required=False, nullable=True)
 
-    def handle(self, context):
-        self.validate_self()
-        if self.errors:
-            return self.errors, INVALID_REQUEST
-
+    def handle(self, context, store=None):
         context["has"] = self.arguments
-        score = 42 if self.is_admin else scoring.get_score(store=context, phone=self.phone, email=self.email,
-                                                           birthday=self.birthday, gender=self.gender,
-                                                           first_name=self.first_name, last_name=self.last_name)
+        score = ADMIN_SCORE if self.is_admin else scoring.get_score(store=store, phone=self.phone, email=self.email,
+                                                                    birthday=self.birthday, gender=self.gender,
+                                                                    first_name=self.first_name,
+                                                                    last_name=self.last_name)
         return {"score": score}, OK
 
+    parameter_sets = (
+        ("phone", "email"),
+        ("first_name", "last_name"),
+        ("gender", "birthday"),
+    )
+
+    @classmethod
+    def has_parameter_set(cls, arguments):
+        """true if both values of one of the pairs are given and aren't empty"""
+        for pair in cls.parameter_sets:
+            if all(arguments.get(name) or isinstance(arguments.get(name), (int, long, float)) for name in pair):
+                return True
+        return False
+
+    @classmethod
+    def check_arguments(cls, arguments):
+        """errors of arguments alone, offline scoring validates them the same way as requests do"""
+        errors = {}
+        cls.validator(arguments, errors)
+        if not errors and not cls.has_parameter_set(arguments):
+            errors["arguments"] = "Invalid arguments list"
+        return errors
+
     def validate_self(self):
         super(OnlineScoreRequest, self).validate_self()
-        if not self.errors:
-            parameter_sets = [
-                ("phone", "email"),
-                ("first_name", "last_name"),
-                ("gender", "birthday")
-            ]
+        if not self.errors and not self.has_parameter_set(self.arguments):
+            self.errors["arguments"] = "Invalid arguments list"
+
+
+class AuthCache(object):
+    """Admin digest is computed once an hour, digests of accounts are kept in LRU of (account, login)"""
+
+    def __init__(self, max_entries=10000):
+        self.digests = LRUCache(max_entries=max_entries)
+        self.admin_digest = None
+        self.admin_digest_expires = 0
+        self.admin_hits = 0
+        self.admin_misses = 0
+
+    def get_admin_digest(self):
+        if time.time() < self.admin_digest_expires:
+            self.admin_hits += 1
+            return self.admin_digest
+        self.admin_misses += 1
+        now = datetime.datetime.now()
+        next_hour = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+        self.admin_digest = hashlib.sha512(now.strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+        self.admin_digest_expires = time.time() + (next_hour - now).total_seconds()
+        return self.admin_digest
+
+    def get_digest(self, account, login):
+        key = (account, login)
+        digest = self.digests.get(key)
+        if digest is None:
+            digest = hashlib.sha512(to_bytes(account + login + SALT)).hexdigest()
+            self.digests.set(key, digest)
+        return digest
+
+    def stats(self):
+        stats = self.digests.stats()
+        stats["admin_hits"] = self.admin_hits
+        stats["admin_misses"] = self.admin_misses
+        return stats
+
+
+AUTH_CACHE = AuthCache()
+
+
+class ResultFlight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class ResultCache(object):
+    """(response, code, context) of method bodies by canonical hash of method, account, login, token and arguments.
+    Concurrent requests of the same key wait for the first one instead of handling it again (single flight).
+    Successful results are kept for ttl seconds, validation errors for error_ttl seconds, the others aren't kept.
+    Only bodies of the methods are cached: results of clients_interests could be big and their keys are costly to hash"""
+
+    def __init__(self, max_entries=10000, ttl=RESULT_TTL, error_ttl=ERROR_TTL, methods=CACHED_METHODS):
+        self.results = LRUCache(max_entries=max_entries)
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.methods = methods
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(body):
+        key = [body.get(name) for name in ("method", "account", "login", "token", "arguments")]
+        return hashlib.md5(jsoncodec.canonical(key)).hexdigest()
+
+    def get(self, key, compute):
+        result = self.results.get(key)
+        if result is not None:
+            metrics.increment("result_cache_hits_total")
+            return result
+        with self.lock:
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = ResultFlight()
+        if not leader:
+            flight.done.wait()
+            if flight.result is not None:
+                metrics.increment("result_cache_coalesced_total")
+                return flight.result
+            return compute()
+
+        metrics.increment("result_cache_misses_total")
+        try:
+            flight.result = compute()
+            ttl = {OK: self.ttl, INVALID_REQUEST: self.error_ttl}.get(flight.result[1])
+            if ttl:
+                self.results.set(key, flight.result, ttl)
+            return flight.result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight.done.set()
+
+    def clear(self):
+        self.results.clear()
+
 
-            if not any([all(name in self.arguments for name in parameters) for parameters in parameter_sets]):
-                self.errors["arguments"] = "Invalid arguments list"
+RESULT_CACHE = ResultCache()
+BATCH_POOL = None
+BATCH_POOL_LOCK = threading.Lock()
+
+
+def to_bytes(value):
+    return value.encode("utf-8") if isinstance(value, unicode) else value
 
 
 def check_auth(request):
+    if not isinstance(request.token, basestring) or not isinstance(request.login, basestring):
+        return False
     if request.login == ADMIN_LOGIN:
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+        digest = AUTH_CACHE.get_admin_digest()
     else:
-        digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
-    if digest == request.token:
-        return True
-    return False
+        digest = AUTH_CACHE.get_digest(request.account or "", request.login)
+    return hmac.compare_digest(digest, to_bytes(request.token))
 
 
-def method_handler(request, context, ctx):
+def process_method(body, context, store, auth=check_auth, results=None):
+    """validates, authenticates and handles one method body, the request object is returned if it was handled.
+    Results of the same bodies are shared through the result cache, only the first of concurrent duplicates
+    is handled and gets the request object back"""
+    results = RESULT_CACHE if results is None else results
+    if not results.ttl or not isinstance(body, dict) or body.get("method") not in results.methods:
+        return run_method(body, context, store, auth)
+    handled = []
+
+    def compute():
+        computed_context = {}
+        response, code, current_request = run_method(body, computed_context, store, auth)
+        handled.append(current_request)
+        return response, code, computed_context
+
+    response, code, computed_context = results.get(results.get_key(body), compute)
+    context.update(computed_context)
+    return response, code, handled[0] if handled else None
+
+
+def run_method(body, context, store, auth=check_auth):
     handlers = {
         "clients_interests": ClientsInterestsRequest,
         "online_score": OnlineScoreRequest,
     }
+    if not isinstance(body, dict):
+        return "Invalid request format", INVALID_REQUEST, None
     try:
-        current_request = handlers[request["body"]["method"]](**request["body"])
+        current_request = handlers[body["method"]].from_body(body)
     except KeyError:
-        return "The request must contain the argument body", INVALID_REQUEST
+        return "The request must contain the argument body", INVALID_REQUEST, None
     except TypeError:
-        return "Invalid request format", INVALID_REQUEST
+        return "Invalid request format", INVALID_REQUEST, None
     except Exception:
-        return "Unexpected error", INVALID_REQUEST
+        return "Unexpected error", INVALID_REQUEST, None
 
-    current_request.validate_self()
+    with metrics.timer("validation"):
+        current_request.validate_self()
 
     if current_request.errors:
-        return current_request.errors, INVALID_REQUEST
-    if not check_auth(current_request):
-        return "Forbidden", FORBIDDEN
+        return current_request.errors, INVALID_REQUEST, None
+    with metrics.timer("auth"):
+        authenticated = auth(current_request)
+    if not authenticated:
+        return "Forbidden", FORBIDDEN, None
+    if current_request.is_admin and isinstance(current_request, OnlineScoreRequest):
+        context["has"] = current_request.arguments
+        return {"score": ADMIN_SCORE}, OK, None
 
-    response, code = current_request.handle(context)
-    if ctx:
-        ctx.update_cache(current_request.account, response)
+    with metrics.timer("handler"):
+        response, code = current_request.handle(context, store)
+    return response, code, current_request
+
+
+def method_handler(request, context, ctx):
+    response, code, current_request = process_method(request["body"], context, ctx)
+    if ctx and current_request:
+        with metrics.timer("store_update"):
+            ctx.update_cache(current_request.account, response)
     return response, code
 
 
-def main_http_handler_with_store(store=None):
-    """Class fabric to pass here database object with all db's parameters """
+def get_batch_pool():
+    """pool of BATCH_WORKERS threads shared by all parallel batches of the process, the first of them creates it"""
+    global BATCH_POOL
+    with BATCH_POOL_LOCK:
+        if BATCH_POOL is None:
+            from multiprocessing.dummy import Pool as ThreadPool
+            BATCH_POOL = ThreadPool(BATCH_WORKERS)
+    return BATCH_POOL
+
+
+def batch_handler(request, context, ctx):
+    """Body is an array of method bodies or {"requests": [...], "parallel": true}.
+    Every distinct (account, login, token) is authenticated once, store is updated once for the whole batch"""
+    body = request["body"]
+    parallel = False
+    if isinstance(body, dict):
+        parallel = bool(body.get("parallel"))
+        body = body.get("requests")
+    if not isinstance(body, list) or not body:
+        return "Batch should be a non-empty array of method requests", INVALID_REQUEST
+    if len(body) > MAX_BATCH_SIZE:
+        return "Batch can't contain more than %s requests" % MAX_BATCH_SIZE, INVALID_REQUEST
+
+    verified = {}
+
+    def auth(current_request):
+        credentials = (current_request.account, current_request.login, current_request.token)
+        if credentials not in verified:
+            verified[credentials] = check_auth(current_request)
+        return verified[credentials]
+
+    def run(item):
+        try:
+            response, code, current_request = process_method(item, {}, ctx, auth)
+        except Exception, e:
+            logging.exception("Unexpected error: %s", e)
+            return make_response_body(None, INTERNAL_ERROR), None
+        return make_response_body(response, code), current_request
+
+    if parallel and len(body) > 1:
+        results = get_batch_pool().map(run, body)
+    else:
+        results = [run(item) for item in body]
+
+    if ctx:
+        records = {}
+        for item_body, current_request in results:
+            if current_request:
+                records.setdefault(current_request.account, {}).update(item_body["response"])
+        with metrics.timer("store_update"):
+            ctx.update_cache_many(records)
+    context["nitems"] = len(body)
+    return [item_body for item_body, _ in results], OK
+
+
+def request_accounts(path, body):
+    """account of every method request of the body as it's claimed, nothing is validated yet"""
+    if path != "batch":
+        body = [body]
+    elif isinstance(body, dict):
+        body = body.get("requests")
+    if not isinstance(body, list):
+        return [None]
+    return [item.get("account") if isinstance(item, dict) else None for item in body]
+
+
+def make_response_body(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+def main_http_handler_with_store(store=None, max_body_size=MAX_BODY_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT,
+                                 max_keepalive_requests=MAX_KEEPALIVE_REQUESTS, gzip_min_size=GZIP_MIN_SIZE,
+                                 limiter=None):
+    """Class fabric to pass here database object with all db's parameters.
+    Connections are kept alive for keepalive_timeout idle seconds (0, the default, closes them after every response),
+    a kept connection holds its worker while it's idle.
+    Requests over limits of limiter are answered with 429 (account) or 503 (global) before they are validated"""
     class MainHTTPHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        wbufsize = -1
+        disable_nagle_algorithm = True
         router = {
-            "method": method_handler
+            "method": method_handler,
+            "batch": batch_handler,
         }
-        store = None
-
-        def __init__(self, *args, **kwargs):
-            BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
-            self.store = store
 
         @staticmethod
         def get_request_id(headers):
-            return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+            return headers.get('HTTP_X_REQUEST_ID') or os.urandom(16).encode("hex")
+
+        def log_message(self, format, *args):
+            """access lines go through logging as well instead of being written to stderr by request thread"""
+            logging.debug("%s " + format, self.client_address[0], *args)
+
+        def handle(self):
+            self.handled_requests = 0
+            BaseHTTPRequestHandler.handle(self)
+
+        def send_body(self, code, body=None, chunks=None, content_type="application/json"):
+            """Sends response with either whole body or an iterator of its chunks. Whole body gets Content-Length,
+            chunks are sent with chunked transfer encoding (HTTP/1.0 clients get them until the connection is closed).
+            Responses bigger than gzip_min_size are compressed for clients accepting gzip.
+            Connection is closed after max_keepalive_requests requests or at once if keep-alive is off"""
+            self.handled_requests += 1
+            if not self.keepalive_timeout or self.handled_requests >= self.max_keepalive_requests:
+                self.close_connection = 1
+            if chunks is not None and self.request_version == "HTTP/1.0":
+                self.close_connection = 1
+            chunked = chunks is not None and not self.close_connection
+            compressor = None
+            if self.gzip_min_size and "gzip" in self.headers.get("Accept-Encoding", "") \
+                    and (chunks is not None or len(body) >= self.gzip_min_size):
+                compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                if chunks is None:
+                    body = compressor.compress(body) + compressor.flush()
+
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            if compressor:
+                self.send_header("Content-Encoding", "gzip")
+            if chunks is None:
+                self.send_header("Content-Length", str(len(body)))
+            elif chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            if self.close_connection:
+                self.send_header("Connection", "close")
+            self.end_headers()
+            if chunks is None:
+                self.wfile.write(body)
+                return
+            for chunk in chunks:
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                self.write_chunk(chunk, chunked)
+            if compressor:
+                self.write_chunk(compressor.flush(), chunked)
+            if chunked:
+                self.wfile.write("0\r\n\r\n")
+
+        def write_chunk(self, chunk, chunked):
+            if not chunk:
+                return
+            if chunked:
+                self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+            else:
+                self.wfile.write(chunk)
+
+        def do_GET(self):
+            """metrics of this process in Prometheus text format or its health: 503 while the store is created,
+            "resetting" while its startup reset goes on, startup timing report either way"""
+            path = self.path.strip("/")
+            if path == "health":
+                code = SERVICE_UNAVAILABLE if self.starting else OK
+                if self.starting:
+                    status = "starting"
+                elif self.store is not None and not self.store.ready.is_set():
+                    status = "resetting"
+                else:
+                    status = "ok"
+                self.send_body(code, jsoncodec.dumps({"status": status, "startup": STARTUP, "code": code}))
+            elif path == "metrics":
+                self.send_body(OK, metrics.render(self.store, AUTH_CACHE),
+                               content_type="text/plain; version=0.0.4")
+            else:
+                self.send_body(NOT_FOUND, jsoncodec.dumps(make_response_body(None, NOT_FOUND)))
 
         def do_POST(self):
+            started = time.time()
             response, code = {}, OK
             context = {"request_id": self.get_request_id(self.headers)}
             request = None
             data_string = None
             try:
-                data_string = self.rfile.read(int(self.headers['Content-Length']))
-                request = json.loads(data_string)
-            except:
+                length = int(self.headers['Content-Length'])
+            except (TypeError, ValueError):
+                length = -1
+            if length < 0:
                 code = BAD_REQUEST
-
-            if request:
+                self.close_connection = 1
+            elif length > self.max_body_size:
+                code = REQUEST_ENTITY_TOO_LARGE
+                self.close_connection = 1
+            else:
+                try:
+                    with metrics.timer("read"):
+                        data_string = self.rfile.read(length)
+                    with metrics.timer("decode"):
+                        request = jsoncodec.loads(data_string)
+                except:
+                    code = BAD_REQUEST
+
+            if request is not None:
                 path = self.path.strip("/")
-                logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
-                if path in self.router:
+                logging.info("%s: %s %s", self.path, data_string, context["request_id"],
+                             extra={"request_id": context["request_id"]})
+                limit = not self.starting and self.limiter and path in self.router \
+                    and self.limiter.admit(request_accounts(path, request))
+                if self.starting and path in self.router:
+                    code = SERVICE_UNAVAILABLE
+                elif limit:
+                    code = TOO_MANY_REQUESTS if limit == "account" else SERVICE_UNAVAILABLE
+                    context["limit"] = limit
+                elif path in self.router:
                     try:
                         response, code = self.router[path]({"body": request, "headers": self.headers}, context,
                                                            self.store)
                     except Exception, e:
-                        logging.exception("Unexpected error: %s" % e)
+                        logging.exception("Unexpected error: %s", e)
                         code = INTERNAL_ERROR
                 else:
                     code = NOT_FOUND
 
-            self.send_response(code)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            if code not in ERRORS:
-                r = {"response": response, "code": code}
+            r = make_response_body(response, code)
+            stream = isinstance(response, (dict, list)) and len(response) > STREAM_MIN_ITEMS
+            context["code"] = code
+            if "error" in r:
+                context["error"] = r["error"]
+            elif stream:
+                context["response_items"] = len(response)
             else:
-                r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-            context.update(r)
-            logging.info(context)
-            self.wfile.write(json.dumps(r))
-            return
+                context["response"] = response
+            logging.info(context, extra={"request_id": context["request_id"]})
+            with metrics.timer("encode"):
+                if stream:
+                    self.send_body(code, chunks=jsoncodec.iterencode(r))
+                else:
+                    self.send_body(code, jsoncodec.dumps(r))
+            metrics.observe("request", time.time() - started)
+    MainHTTPHandler.store = store
+    MainHTTPHandler.max_body_size = max_body_size
+    MainHTTPHandler.timeout = keepalive_timeout or None
+    MainHTTPHandler.keepalive_timeout = keepalive_timeout
+    MainHTTPHandler.max_keepalive_requests = max_keepalive_requests
+    MainHTTPHandler.gzip_min_size = gzip_min_size
+    MainHTTPHandler.limiter = limiter
+    MainHTTPHandler.starting = False
     return MainHTTPHandler
 
 
+class ThreadPoolHTTPServer(HTTPServer):
+    """Accepted connections are handed over to a fixed pool of worker threads through a bounded queue.
+    With shed_load connections are answered with 503 at once instead of waiting for the queue when it's full,
+    as well as connections waiting in the queue longer than queue_timeout seconds"""
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, workers=8, queue_size=MAX_QUEUE, queue_timeout=0,
+                 shed_load=False):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.requests = Queue.Queue(maxsize=queue_size)
+        self.queue_timeout = queue_timeout
+        self.shed_load = shed_load
+        self.workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self.process_queue)
+            worker.daemon = self.daemon_threads
+            worker.start()
+            self.workers.append(worker)
+
+    def process_queue(self):
+        while True:
+            request, client_address, queued_at = self.requests.get()
+            if request is None:
+                return
+            waited = time.time() - queued_at
+            metrics.observe("queue", waited)
+            try:
+                if self.queue_timeout and waited > self.queue_timeout:
+                    self.reject(request)
+                    continue
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if not self.shed_load:
+            self.requests.put((request, client_address, time.time()))
+            return
+        try:
+            self.requests.put_nowait((request, client_address, time.time()))
+        except Queue.Full:
+            self.reject(request)
+            self.shutdown_request(request)
+
+    @staticmethod
+    def reject(request):
+        """503 without reading the request, what has already arrived is drained so closing doesn't reset the answer"""
+        metrics.increment("requests_shed_total")
+        body = jsoncodec.dumps(make_response_body(None, SERVICE_UNAVAILABLE))
+        try:
+            request.settimeout(0)
+            try:
+                request.recv(MAX_BODY_SIZE)
+            except socket.error:
+                pass
+            request.settimeout(1)
+            request.sendall("HTTP/1.1 %s %s\r\nContent-Type: application/json\r\nContent-Length: %s\r\n"
+                            "Connection: close\r\n\r\n%s" % (SERVICE_UNAVAILABLE, ERRORS[SERVICE_UNAVAILABLE],
+                                                               len(body), body))
+        except socket.error:
+            pass
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        for _ in self.workers:
+            self.requests.put((None, None, None))
+        for worker in self.workers:
+            worker.join()
+
+
+def make_store(store_config, startup=None):
+    return BaseStore.create_store(db_config=store_config, startup=startup, logger=logging)
+
+
+def make_limiter(limits_config, store):
+    if limits_config:
+        import ratelimit
+        return ratelimit.create_limiter(limits_config, store)
+
+
+def log_startup(phase):
+    """startup timing report: seconds from the start of api import till the phase, they are returned by /health"""
+    STARTUP[phase] = round(time.time() - STARTED, 4)
+    logging.info("Startup: %s in %.3fs", phase, STARTUP[phase])
+
+
+def attach_store(server, store_config, limits_config=None, startup=None, wait_fd=None):
+    """Store and rate limiter of the server handler are created by background thread, so the port is served at once.
+    Until the store is created method requests and /health are answered with 503, so updates of accounts aren't lost.
+    Startup reset of the store doesn't hold requests, the store keeps their writes until it's ready.
+    With wait_fd the store isn't ready until the other end is closed. Failed creation of the store stops the server"""
+    handler_class = server.RequestHandlerClass
+    handler_class.starting = True
+
+    def connect():
+        try:
+            store = make_store(store_config, startup)
+            if wait_fd is not None:
+                store.ready.clear()
+            handler_class.limiter = make_limiter(limits_config, store)
+            handler_class.store = store
+        except Exception, e:
+            logging.exception("Store isn't created: %s", e)
+            server.shutdown()
+            return
+        handler_class.starting = False
+        log_startup("store")
+        if wait_fd is not None:
+            os.read(wait_fd, 1)
+            os.close(wait_fd)
+            store.ready.set()
+        store.ready.wait()
+        log_startup("ready")
+
+    connector = threading.Thread(target=connect, name="StoreConnect")
+    connector.daemon = True
+    connector.start()
+    return connector
+
+
+def detach_store(server, connector):
+    """closes store and limiter of the stopped server, False if they were never created"""
+    connector.join()
+    handler_class = server.RequestHandlerClass
+    if handler_class.limiter:
+        handler_class.limiter.close()
+    if handler_class.store is None:
+        return False
+    handler_class.store.close()
+    return True
+
+
+def stop_worker(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve_prefork(port, workers, store_config, limits_config=None, **handler_options):
+    """Listen socket is bound once and shared by forked workers, each of them has own store connection
+    and rate limiter. Workers serve at once, but their stores write nothing until startup reset
+    of the store (if it's configured) is done by the parent.
+    False is returned if the parent couldn't create the store"""
+    server = HTTPServer(("0.0.0.0", port), main_http_handler_with_store())
+    log_startup("listening")
+    reset_done, reset_done_write = os.pipe()
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, stop_worker)
+            os.close(reset_done_write)
+            connector = None
+            try:
+                server.RequestHandlerClass = main_http_handler_with_store(**handler_options)
+                connector = attach_store(server, store_config, limits_config, startup="keep", wait_fd=reset_done)
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                attached = connector is not None and detach_store(server, connector)
+                logging.shutdown()
+                os._exit(0 if attached else 1)
+        children.append(pid)
+
+    os.close(reset_done)
+    logging.info("Starting %s prefork workers at %s", workers, port)
+    started = True
+    try:
+        try:
+            make_store(store_config).close()
+        finally:
+            os.close(reset_done_write)
+        for pid in children:
+            os.waitpid(pid, 0)
+    except (KeyboardInterrupt, Exception), e:
+        if not isinstance(e, KeyboardInterrupt):
+            logging.exception("Store isn't created: %s", e)
+            started = False
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+    server.server_close()
+    return started
+
+
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
     op.add_option("-s", "--store_config", default=None)
+    op.add_option("--limits_config", default=None)
+    op.add_option("-m", "--mode", action="store", type="choice", choices=SERVING_MODES, default="single")
+    op.add_option("-w", "--workers", action="store", type=int, default=4)
+    op.add_option("--max_body_size", action="store", type=int, default=MAX_BODY_SIZE)
+    op.add_option("--keepalive_timeout", action="store", type=float, default=KEEPALIVE_TIMEOUT)
+    op.add_option("--max_keepalive_requests", action="store", type=int, default=MAX_KEEPALIVE_REQUESTS)
+    op.add_option("--gzip_min_size", action="store", type=int, default=GZIP_MIN_SIZE)
+    op.add_option("--result_ttl", action="store", type=float, default=RESULT_TTL)
+    op.add_option("--error_ttl", action="store", type=float, default=ERROR_TTL)
+    op.add_option("--log_json", action="store_true", default=False)
+    op.add_option("--log_sample", action="store", type=float, default=1)
+    op.add_option("--log_max_length", action="store", type=int, default=0)
+    op.add_option("--log_queue", action="store", type=int, default=10000)
     (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    persistent_storage = RedisStore.RedisStore(db_config=opts.store_config, logger=logging)
-    HTTPHandler = main_http_handler_with_store(persistent_storage)
-    server = HTTPServer(("0.0.0.0", opts.port), HTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
+    asynclog.setup(filename=opts.log, level=logging.INFO, json_lines=opts.log_json, sample_rate=opts.log_sample,
+                   max_length=opts.log_max_length, queue_size=opts.log_queue)
+    log_startup("imports")
+    RESULT_CACHE.ttl = opts.result_ttl
+    RESULT_CACHE.error_ttl = opts.error_ttl
+    handler_options = {
+        "max_body_size": opts.max_body_size,
+        "keepalive_timeout": opts.keepalive_timeout if opts.mode != "single" else 0,
+        "max_keepalive_requests": opts.max_keepalive_requests,
+        "gzip_min_size": opts.gzip_min_size,
+    }
+    if opts.mode == "prefork":
+        started = serve_prefork(opts.port, opts.workers, opts.store_config, opts.limits_config, **handler_options)
+        raise SystemExit(0 if started else 1)
+
+    HTTPHandler = main_http_handler_with_store(**handler_options)
+    if opts.mode == "thread":
+        limits = BaseStore.BaseStore.parse_config(opts.limits_config) if opts.limits_config else {}
+        server = ThreadPoolHTTPServer(("0.0.0.0", opts.port), HTTPHandler, workers=opts.workers,
+                                      queue_size=int(limits.get("max_queue", MAX_QUEUE)),
+                                      queue_timeout=float(limits.get("queue_timeout", 0)),
+                                      shed_load=bool(limits))
+    else:
+        server = HTTPServer(("0.0.0.0", opts.port), HTTPHandler)
+    log_startup("listening")
+    connector = attach_store(server, opts.store_config, opts.limits_config)
+    logging.info("Starting server at %s in %s mode", opts.port, opts.mode)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
     server.server_close()
+    if not detach_store(server, connector):
+        raise SystemExit(1)
@@ -0,0 +1,143 @@
+import os
+import json
+import zlib
+import Queue
+import random
+import logging
+import threading
+
+import metrics
+
+TEXT_FORMAT = "[%(asctime)s] %(levelname).1s %(message)s"
+DATE_FORMAT = "%Y.%m.%d %H:%M:%S"
+
+
+def truncate(message, max_length):
+    if not max_length or len(message) <= max_length:
+        return message
+    return "%s... (%s more)" % (message[:max_length], len(message) - max_length)
+
+
+class AsyncHandler(logging.Handler):
+    """Records are put into a bounded queue and written into the target handler by background thread,
+    so request threads never wait for the disk. Messages are formatted by the writer as well.
+    Records are dropped and counted while the queue is full. Forked process starts own writer on its first record"""
+
+    def __init__(self, target, queue_size=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.start()
+
+    def start(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(maxsize=self.queue_size)
+        self.writer = threading.Thread(target=self.write, name="LogWriter")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+            metrics.increment("log_records_dropped_total")
+
+    def write(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.handleError(record)
+
+    def close(self):
+        """writes everything queued before closing the target"""
+        if self.pid == os.getpid() and self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class TextFormatter(logging.Formatter):
+    """usual text lines, messages longer than max_length are truncated"""
+
+    def __init__(self, fmt=TEXT_FORMAT, datefmt=DATE_FORMAT, max_length=0):
+        logging.Formatter.__init__(self, fmt, datefmt)
+        self.max_length = max_length
+
+    def format(self, record):
+        record.msg = truncate(record.getMessage(), self.max_length)
+        record.args = ()
+        return logging.Formatter.format(self, record)
+
+
+class JSONFormatter(logging.Formatter):
+    """one JSON object per line. Dictionary logged as a message (e.g. context of request) becomes fields
+    of the object, every field encoded longer than max_length is replaced with its truncated encoding"""
+
+    def __init__(self, datefmt=DATE_FORMAT, max_length=0):
+        logging.Formatter.__init__(self, None, datefmt)
+        self.max_length = max_length
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record, self.datefmt), "level": record.levelname}
+        if isinstance(record.msg, dict) and not record.args:
+            for key, value in record.msg.iteritems():
+                entry[key] = self.truncate_field(value)
+        else:
+            entry["message"] = truncate(record.getMessage(), self.max_length)
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=repr)
+
+    def truncate_field(self, value):
+        if not self.max_length or isinstance(value, (int, long, float, bool)) or value is None:
+            return value
+        encoded = json.dumps(value, default=repr)
+        if len(encoded) <= self.max_length:
+            return value
+        return truncate(encoded, self.max_length)
+
+
+class SamplingFilter(logging.Filter):
+    """keeps share `rate` of records up to INFO level, warnings and errors are always kept.
+    Records with the same request_id are either all kept or all dropped"""
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.threshold = int(rate * 0x100000000)
+
+    def filter(self, record):
+        if self.rate >= 1 or record.levelno > logging.INFO:
+            return True
+        request_id = getattr(record, "request_id", None)
+        if request_id is None:
+            return random.random() < self.rate
+        return zlib.crc32(request_id) & 0xffffffff < self.threshold
+
+
+def setup(filename=None, level=logging.INFO, json_lines=False, sample_rate=1, max_length=0, queue_size=10000):
+    """replaces logging.basicConfig: root logger writes into file (stderr if there is no file) through AsyncHandler"""
+    target = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    target.setFormatter(JSONFormatter(max_length=max_length) if json_lines else TextFormatter(max_length=max_length))
+    handler = AsyncHandler(target, queue_size=queue_size)
+    if sample_rate < 1:
+        handler.addFilter(SamplingFilter(sample_rate))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import csv
+import sys
+import itertools
+import collections
+import multiprocessing
+from optparse import OptionParser
+
+import api
+import jsoncodec
+import scoring
+
+FIELDS = ("phone", "email", "birthday", "gender", "first_name", "last_name")
+FORMATS = ("jsonl", "csv")
+
+
+def read_jsonl(f):
+    """lines are decoded by workers, empty lines are skipped"""
+    for number, line in enumerate(f, 1):
+        if line.strip():
+            yield number, line
+
+
+def read_csv(f):
+    """header names the columns, empty cells are missing arguments"""
+    for number, row in enumerate(csv.DictReader(f), 2):
+        arguments = dict((name, value) for name, value in row.iteritems() if value)
+        if arguments.get("gender", "").isdigit():
+            arguments["gender"] = int(arguments["gender"])
+        yield number, arguments
+
+
+def chunks(records, chunk_size):
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def score_chunk(chunk):
+    """JSON lines of scores of (line number, arguments) records, invalid arguments get errors instead.
+    Arguments are validated by OnlineScoreRequest, valid ones are scored at once by scoring.get_scores.
+    Optional id of a record is returned with its score"""
+    output = [None] * len(chunk)
+    valid = []
+    for index, (number, arguments) in enumerate(chunk):
+        if isinstance(arguments, basestring):
+            try:
+                arguments = jsoncodec.loads(arguments)
+            except ValueError:
+                arguments = None
+        line = {"line": number}
+        if not isinstance(arguments, dict):
+            line["error"] = "Invalid record format"
+            output[index] = line
+            continue
+        if "id" in arguments:
+            line["id"] = arguments["id"]
+        errors = api.OnlineScoreRequest.check_arguments(arguments)
+        if errors:
+            line["error"] = errors
+        else:
+            valid.append((index, arguments))
+        output[index] = line
+
+    if valid:
+        columns = [[bool(arguments.get(name)) for _, arguments in valid] for name in FIELDS]
+        for (index, _), score in zip(valid, scoring.get_scores(*columns)):
+            output[index]["score"] = float(score)
+    return "".join(jsoncodec.dumps(line) + "\n" for line in output)
+
+
+def score_chunks(chunks, processes=0):
+    """scored chunks in order. With processes they are scored by a pool, but no more than two chunks
+    per process are taken ahead, so memory is bounded whatever the size of input is"""
+    if not processes:
+        for chunk in chunks:
+            yield score_chunk(chunk)
+        return
+    pool = multiprocessing.Pool(processes)
+    pending = collections.deque()
+    try:
+        for chunk in chunks:
+            pending.append(pool.apply_async(score_chunk, (chunk,)))
+            if len(pending) >= processes * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main(opts, source, target):
+    fmt = opts.format or ("csv" if source.name.endswith(".csv") else "jsonl")
+    records = read_csv(source) if fmt == "csv" else read_jsonl(source)
+    for scored in score_chunks(chunks(records, opts.chunk_size), opts.processes):
+        target.write(scored)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] input [output]\n"
+                            "Scores online_score arguments of JSONL or CSV input, writes JSON lines of scores")
+    op.add_option("-f", "--format", action="store", type="choice", choices=FORMATS, default=None,
+                  help="input format, by default csv for .csv files and jsonl otherwise")
+    op.add_option("-c", "--chunk_size", action="store", type=int, default=10000)
+    op.add_option("-p", "--processes", action="store", type=int, default=0,
+                  help="size of process pool, 0 scores in this process")
+    (opts, args) = op.parse_args()
+    if not 1 <= len(args) <= 2:
+        op.error("input file is expected")
+    with open(args[0]) as source:
+        if len(args) == 2:
+            with open(args[1], "w") as target:
+                main(opts, source, target)
+        else:
+            main(opts, source, sys.stdout)
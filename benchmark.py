@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import Queue
+import random
+import hashlib
+import httplib
+import tempfile
+import threading
+import timeit
+from collections import Counter
+from optparse import OptionParser
+
+import serializers
+
+INTERESTS = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+VALIDATION_SAMPLES = [
+    ("online_score", {"phone": "79175002040", "email": "stupnikov@otus.ru"}),
+    ("online_score", {"phone": 79175002040, "email": "stupnikov@otus.ru", "gender": 1, "birthday": "01.01.1990",
+                      "first_name": "a", "last_name": "b"}),
+    ("online_score", {"phone": "89175002040", "email": "stupnikovotus.ru", "birthday": "XXX"}),
+    ("clients_interests", {"client_ids": range(10), "date": "20.05.2018"}),
+    ("clients_interests", {"client_ids": [1, "2"], "date": "GGGG"}),
+]
+
+
+def make_record(nclients):
+    """account record as it is kept in store: score and interests of every client"""
+    record = {"score": 3.5}
+    for cid in range(nclients):
+        record[cid] = random.sample(INTERESTS, 2)
+    return record
+
+
+def bench_codecs(sizes, number):
+    """prints encode/decode cost of one record per codec and record size"""
+    print "%-10s %8s %10s %12s %12s" % ("codec", "clients", "bytes", "encode, us", "decode, us")
+    for nclients in sizes:
+        record = make_record(nclients)
+        for name in sorted(serializers.SERIALIZERS):
+            serializer = serializers.SERIALIZERS[name]
+            raw = serializer.dumps(record)
+            encode = timeit.timeit(lambda: serializer.dumps(record), number=number) / number
+            decode = timeit.timeit(lambda: serializers.loads(raw), number=number) / number
+            print "%-10s %8s %10s %12.2f %12.2f" % (name, nclients, len(raw), encode * 10 ** 6, decode * 10 ** 6)
+
+
+def bench_validation(number):
+    """prints cost of building and validating one request of every sample"""
+    import api
+    handlers = {
+        "clients_interests": api.ClientsInterestsRequest,
+        "online_score": api.OnlineScoreRequest,
+    }
+
+    def validate(method, arguments):
+        request = handlers[method](account="horns&hoofs", login="h&f", token="token", method=method,
+                                   arguments=arguments)
+        request.validate_self()
+        return request
+
+    print "%-18s %6s %14s  %s" % ("method", "valid", "validate, us", "arguments")
+    total = 0
+    for method, arguments in VALIDATION_SAMPLES:
+        valid = not validate(method, arguments).errors
+        cost = timeit.timeit(lambda: validate(method, arguments), number=number) / number
+        total += cost
+        print "%-18s %6s %14.2f  %s" % (method, valid, cost * 10 ** 6, ", ".join(sorted(arguments)))
+    print "mean per request: %.2f us" % (total / len(VALIDATION_SAMPLES) * 10 ** 6)
+
+
+def make_store(backend, **options):
+    import BaseStore
+    module = __import__(BaseStore.BACKENDS[backend])
+    options.setdefault("flush_interval", 0)
+    options.setdefault("max_cache_size", 10 ** 9)
+    if backend == "sqlite":
+        options["path"] = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    elif backend == "redis":
+        options["key_prefix"] = "benchmark:"
+    return getattr(module, BaseStore.BACKENDS[backend])(**options)
+
+
+def bench_stores(backends, number):
+    """prints cost of flushing, reading records and reading values in bulk per backend, every backend
+    gets the same records and values"""
+    records = dict(("account%s" % i, make_record(10)) for i in range(number))
+    keys = ["i:%s" % i for i in range(number)]
+    print "%-8s %12s %12s %12s %14s" % ("backend", "records", "flush, us", "get, us", "get_many, us")
+    for backend in backends:
+        store = make_store(backend)
+        try:
+            store.update_cache_many(records)
+            flush = timeit.timeit(store.flush_cache, number=1) / number
+            get = timeit.timeit(lambda: [store.get(key) for key in records], number=1) / number
+            for key in keys:
+                store.cached_set(key, random.sample(INTERESTS, 2))
+            store.local.clear()
+            get_many = timeit.timeit(lambda: store.get_values(keys), number=1) / number
+            print "%-8s %12s %12.2f %12.2f %14.2f" % (backend, number, flush * 10 ** 6, get * 10 ** 6,
+                                                       get_many * 10 ** 6)
+        finally:
+            store.close()
+            store.destroy_store()
+
+
+def make_request(method, arguments, account="horns&hoofs", login="h&f"):
+    """method request body with valid token"""
+    import api
+    token = hashlib.sha512(account + login + api.SALT).hexdigest()
+    return {"account": account, "login": login, "token": token, "method": method, "arguments": arguments}
+
+
+def synthetic_requests(number, score_share):
+    """(path, body) pairs of online_score requests (score_share of them) and clients_interests requests"""
+    for _ in range(number):
+        if random.random() < score_share:
+            arguments = {"phone": "7%010d" % random.randint(0, 999), "email": "user%s@otus.ru" % random.randint(0, 999),
+                         "first_name": "a", "last_name": "b"}
+            yield "method", make_request("online_score", arguments)
+        else:
+            arguments = {"client_ids": random.sample(range(1000), random.randint(1, 10)), "date": "20.05.2018"}
+            yield "method", make_request("clients_interests", arguments)
+
+
+def read_corpus(path, number):
+    """(path, body) pairs of JSONL corpus, replayed in a loop up to number requests.
+    Every line is either {"path": "method"|"batch", "body": ...} or a method request body itself"""
+    with open(path) as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+    for index in range(number):
+        item = corpus[index % len(corpus)]
+        if isinstance(item, dict) and "path" in item and "body" in item:
+            yield item["path"], item["body"]
+        else:
+            yield "method", item
+
+
+def start_server(backend, workers):
+    """api server of thread mode on a free local port, backend 'none' runs it without store"""
+    import api
+    store = None if backend == "none" else make_store(backend, flush_interval=1, max_cache_size=10 ** 6)
+    server = api.ThreadPoolHTTPServer(("127.0.0.1", 0), api.main_http_handler_with_store(store), workers=workers)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, store
+
+
+def percentile(ordered, share):
+    """nearest-rank percentile of sorted values"""
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(round(share * len(ordered) + 0.5)) - 1)]
+
+
+def run_load(host, port, requests, concurrency):
+    """sends requests by concurrency connections at once, returns latencies in seconds, counts of
+    response codes and the elapsed time"""
+    pending = Queue.Queue()
+    for request in requests:
+        pending.put(request)
+    latencies = []
+    codes = Counter()
+    lock = threading.Lock()
+
+    def worker():
+        connection = httplib.HTTPConnection(host, port, timeout=30)
+        while True:
+            try:
+                path, body = pending.get_nowait()
+            except Queue.Empty:
+                break
+            data = json.dumps(body)
+            started = time.time()
+            try:
+                connection.request("POST", "/%s/" % path, data, {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                response.read()
+                code = response.status
+            except (httplib.HTTPException, IOError):
+                connection.close()
+                code = "error"
+            latency = time.time() - started
+            with lock:
+                latencies.append(latency)
+                codes[code] += 1
+        connection.close()
+
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sorted(latencies), codes, time.time() - started
+
+
+def bench_load(opts):
+    """prints throughput and latency percentiles of requests replayed from corpus or generated.
+    Without --url the server is started in this process with the chosen store backend"""
+    if opts.corpus:
+        requests = list(read_corpus(opts.corpus, opts.number))
+    else:
+        requests = list(synthetic_requests(opts.number, opts.score_share))
+    server = store = None
+    if opts.url:
+        host, _, port = opts.url.partition(":")
+        port = int(port or 80)
+    else:
+        server, store = start_server(opts.backend, opts.workers)
+        host, port = server.server_address
+    try:
+        latencies, codes, elapsed = run_load(host, port, requests, opts.concurrency)
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        if store:
+            store.close()
+            store.destroy_store()
+    print "requests: %s, concurrency: %s, elapsed: %.2f s" % (len(latencies), opts.concurrency, elapsed)
+    print "throughput: %.1f requests/s" % (len(latencies) / elapsed)
+    print "latency, ms: p50 %.2f, p95 %.2f, p99 %.2f, max %.2f" % tuple(
+        percentile(latencies, share) * 1000 for share in (0.5, 0.95, 0.99, 1))
+    print "codes: %s" % ", ".join("%s: %s" % item for item in sorted(codes.items()))
+
+
+def bench_handlers(backend, number):
+    """prints cost of the request path pieces in isolation: auth, validation, whole method handling
+    (the result cache is off, so every call is handled) and writing records into store"""
+    import api
+    api.RESULT_CACHE.ttl = 0
+    store = None if backend == "none" else make_store(backend)
+    score_body = make_request("online_score", {"phone": "79175002040", "email": "stupnikov@otus.ru"})
+    interests_body = make_request("clients_interests", {"client_ids": range(10), "date": "20.05.2018"})
+    request = api.MethodRequest(**score_body)
+    request.validate_self()
+    records = dict(("account%s" % i, make_record(10)) for i in range(100))
+    cases = [
+        ("check_auth", lambda: api.check_auth(request)),
+        ("validate_self", lambda: api.OnlineScoreRequest(**score_body).validate_self()),
+        ("method_handler score", lambda: api.method_handler({"body": score_body, "headers": {}}, {}, store)),
+        ("method_handler interests", lambda: api.method_handler({"body": interests_body, "headers": {}}, {},
+                                                                store)),
+    ]
+    if store:
+        cases.append(("update_db 100 records", lambda: store.update_db(**records)))
+    print "%-26s %12s" % ("operation", "cost, us")
+    try:
+        for name, call in cases:
+            call()
+            print "%-26s %12.2f" % (name, timeit.timeit(call, number=number) / number * 10 ** 6)
+    finally:
+        if store:
+            store.close()
+            store.destroy_store()
+
+
+BENCHMARKS = {
+    "codecs": lambda opts: bench_codecs([int(size) for size in opts.sizes.split(",")], opts.number),
+    "validation": lambda opts: bench_validation(opts.number),
+    "stores": lambda opts: bench_stores(opts.backends.split(","), opts.number),
+    "load": bench_load,
+    "handlers": lambda opts: bench_handlers(opts.backend, opts.number),
+}
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%%prog [options] %s" % "|".join(sorted(BENCHMARKS)))
+    op.add_option("--sizes", action="store", default="1,10,100,1000",
+                  help="comma separated numbers of clients in benchmarked records")
+    op.add_option("--backends", action="store", default="memory,sqlite,redis",
+                  help="comma separated store backends to compare")
+    op.add_option("--backend", action="store", default="memory",
+                  help="store backend of load and handlers benchmarks: redis, memory, sqlite or none")
+    op.add_option("--corpus", action="store", default=None,
+                  help="JSONL file of requests to replay instead of synthetic online_score/clients_interests mix")
+    op.add_option("--score_share", action="store", type=float, default=0.5,
+                  help="share of online_score requests in synthetic mix")
+    op.add_option("--url", action="store", default=None, help="host:port of running server to load")
+    op.add_option("-c", "--concurrency", action="store", type=int, default=8)
+    op.add_option("-w", "--workers", action="store", type=int, default=8,
+                  help="worker threads of the server started by load benchmark")
+    op.add_option("-n", "--number", action="store", type=int, default=1000)
+    (opts, args) = op.parse_args()
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        op.error("benchmark name is expected")
+    BENCHMARKS[args[0]](opts)
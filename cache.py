@@ -0,0 +1,191 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+
+def get_object_size(value):
+    """deep size of record values: containers are measured with everything they hold"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            size += get_object_size(key) + get_object_size(item)
+    elif isinstance(value, (list, tuple, set)):
+        for item in value:
+            size += get_object_size(item)
+    return size
+
+
+class WriteBehindCache(object):
+    """Records of accounts kept in LRU order until they are written into db.
+    Size of every record is accounted field by field on update, so the budget check is O(1).
+    Dirty records are never evicted, they have to be taken for flush and marked clean first.
+    Clean records are kept in own LRU order, so eviction doesn't scan dirty ones while db is unavailable"""
+
+    def __init__(self, max_size=1000, max_entries=0, max_age=0):
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.versions = {}
+        self.dirty = OrderedDict()
+        self.clean = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        record = self.entries.get(key)
+        if record is None:
+            self.misses += 1
+            return
+        self.hits += 1
+        self.entries[key] = self.entries.pop(key)
+        if key in self.clean:
+            self.clean[key] = self.clean.pop(key)
+        return record
+
+    def update(self, key, data):
+        """merges data into the record of key and marks it dirty, merge into a cached record is counted as a hit"""
+        record = self.entries.pop(key, None)
+        if record is None:
+            self.misses += 1
+            record = {}
+            record_size = 0
+        else:
+            self.hits += 1
+            record_size = self.sizes[key] - sys.getsizeof(record)
+        for field, value in data.iteritems():
+            if field in record:
+                record_size -= get_object_size(field) + get_object_size(record[field])
+            record[field] = value
+            record_size += get_object_size(field) + get_object_size(value)
+        record_size += sys.getsizeof(record)
+
+        self.entries[key] = record
+        self.size += record_size - self.sizes.get(key, 0)
+        self.sizes[key] = record_size
+        self.versions[key] = self.versions.get(key, 0) + 1
+        if key not in self.dirty:
+            self.dirty[key] = time.time()
+            self.clean.pop(key, None)
+
+    def is_full(self):
+        if self.max_entries and len(self.entries) > self.max_entries:
+            return True
+        return self.size >= self.max_size
+
+    def has_expired(self, now=None):
+        """true if the oldest dirty record waits for flush longer than max_age"""
+        if not self.max_age or not self.dirty:
+            return False
+        oldest = next(self.dirty.itervalues())
+        return (now or time.time()) - oldest >= self.max_age
+
+    def take_dirty(self):
+        """copies of dirty records to write and their versions to pass into mark_clean after the write"""
+        records = {}
+        versions = {}
+        for key in self.dirty:
+            records[key] = self.entries[key].copy()
+            versions[key] = self.versions[key]
+        return records, versions
+
+    def mark_clean(self, versions):
+        """records updated after they were taken for flush stay dirty, the others join clean ones in LRU order"""
+        for key in [key for key in self.entries if key in versions]:
+            if self.versions[key] == versions[key] and self.dirty.pop(key, None) is not None:
+                self.clean[key] = True
+        self.flushes += 1
+
+    def evict(self):
+        """drops clean records least recently used or flushed while the cache is over budget, the latest one is always kept"""
+        while self.clean and self.is_full() and len(self.entries) > 1:
+            self.remove(next(self.clean.iterkeys()))
+            self.evictions += 1
+
+    def remove(self, key):
+        del self.entries[key]
+        self.size -= self.sizes.pop(key)
+        self.versions.pop(key)
+        self.dirty.pop(key, None)
+        self.clean.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.versions.clear()
+        self.dirty.clear()
+        self.clean.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "dirty": len(self.dirty),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "flushes": self.flushes,
+            "evictions": self.evictions,
+        }
+
+
+class LRUCache(object):
+    """Thread safe LRU of plain values, every value could have own time to live in seconds"""
+
+    def __init__(self, max_entries=10000, ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or (entry[1] and entry[1] <= time.time()):
+                self.misses += 1
+                return
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else 0
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires_at)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
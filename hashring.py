@@ -0,0 +1,43 @@
+import bisect
+import hashlib
+
+
+class HashRing(object):
+    """Consistent hashing of keys onto nodes. Every node is placed on the ring as `replicas` virtual points,
+    so adding or removing a node moves only about 1/N of keys"""
+
+    def __init__(self, nodes=(), replicas=160):
+        self.replicas = replicas
+        self.points = []
+        self.owners = []
+        self.nodes = []
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def hash(value):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+    def add_node(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for replica in range(self.replicas):
+            point = self.hash("%s#%s" % (node, replica))
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove_node(self, node):
+        self.nodes.remove(node)
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+        self.points = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+
+    def get_node(self, key):
+        if not self.points:
+            raise LookupError("Hash ring has no nodes")
+        index = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+        return self.owners[index]
@@ -0,0 +1,74 @@
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+if ujson:
+    NAME = "ujson"
+
+    def loads(data):
+        return ujson.loads(data)
+
+    def dumps(value):
+        """values ujson can't encode (e.g. too big integers) are encoded by stdlib json"""
+        try:
+            return ujson.dumps(value, escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return json.dumps(value)
+else:
+    NAME = "json"
+    loads = json.loads
+    dumps = json.dumps
+
+
+def canonical(value):
+    """the same JSON for equal values whatever the order of their keys is"""
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=repr)
+
+
+def iterencode(value, depth=2, chunk_size=STREAM_CHUNK_SIZE):
+    """JSON of value in pieces of about chunk_size bytes. Dictionaries and lists of the first depth levels
+    are encoded item by item, so a big response never exists as one string"""
+    buffer = []
+    size = 0
+    for piece in encode_items(value, depth):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def encode_items(value, depth):
+    if not depth:
+        yield dumps(value)
+    elif isinstance(value, dict):
+        yield "{"
+        separator = ""
+        for key, item in value.iteritems():
+            yield separator
+            yield dumps(key if isinstance(key, basestring) else dumps(key))
+            yield ": "
+            for piece in encode_items(item, depth - 1):
+                yield piece
+            separator = ", "
+        yield "}"
+    elif isinstance(value, (list, tuple)):
+        yield "["
+        separator = ""
+        for item in value:
+            yield separator
+            for piece in encode_items(item, depth - 1):
+                yield piece
+            separator = ", "
+        yield "]"
+    else:
+        yield dumps(value)
@@ -0,0 +1,111 @@
+import time
+import bisect
+import threading
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Histogram(object):
+    """Cumulative histogram of observed values per label value, exported in Prometheus text format.
+    An observation is one bisect and one short locked increment, so it's cheap enough for every request"""
+
+    def __init__(self, name, description, label, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            series = [(label_value, list(counts), total) for label_value, (counts, total) in self.series.items()]
+        for label_value, counts, total in sorted(series):
+            labels = '%s="%s"' % (self.label, label_value)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %s' % (self.name, labels, bound, cumulative))
+            lines.append("%s_sum{%s} %r" % (self.name, labels, total))
+            lines.append("%s_count{%s} %s" % (self.name, labels, cumulative))
+        return lines
+
+
+class Counters(object):
+    """Named counters of events, each one is exported as a Prometheus counter"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def render(self):
+        lines = []
+        with self.lock:
+            values = sorted(self.values.items())
+        for name, value in values:
+            name = "%s_%s" % (self.prefix, name)
+            lines.extend(["# TYPE %s counter" % name, "%s %s" % (name, value)])
+        return lines
+
+
+PHASES = Histogram("scoring_phase_seconds", "Time spent in phases of request handling", "phase")
+COUNTERS = Counters("scoring")
+
+
+class timer(object):
+    """context manager observing time of the block as the phase of PHASES histogram"""
+    __slots__ = ("phase", "started")
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        PHASES.observe(self.phase, time.time() - self.started)
+
+
+def observe(phase, seconds):
+    PHASES.observe(phase, seconds)
+
+
+def increment(name, value=1):
+    COUNTERS.increment(name, value)
+
+
+def render_stats(prefix, stats):
+    """stats ending with _total are counters, the others are gauges"""
+    lines = []
+    for name, value in sorted(stats.items()):
+        name = "%s_%s" % (prefix, name)
+        lines.extend(["# TYPE %s %s" % (name, "counter" if name.endswith("_total") else "gauge"),
+                      "%s %s" % (name, value)])
+    return lines
+
+
+def render(store=None, auth_cache=None):
+    """metrics of this process in Prometheus text format, numbers of the store and of the cache of auth digests
+    are exported as they are now"""
+    lines = PHASES.render() + COUNTERS.render()
+    if store is not None:
+        lines += render_stats("scoring_store", store.stats())
+    if auth_cache is not None:
+        lines += render_stats("scoring_auth_cache", dict(("%s%s" % (name, "" if name == "entries" else "_total"), value)
+                                                         for name, value in auth_cache.stats().iteritems()))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,140 @@
+import time
+import threading
+
+import metrics
+from cache import LRUCache
+from BaseStore import BaseStore
+
+GLOBAL = "global"
+COUNTER_PREFIX = "rate:"
+
+
+class TokenBucket(object):
+    """rate tokens a second up to burst, tokens could go below zero when others' usage is subtracted"""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def spend(self, tokens):
+        self.tokens = max(self.tokens - tokens, -self.burst)
+
+
+class RateLimiter(object):
+    """Token buckets of every account (account_rate requests a second, up to account_burst at once) and
+    of all requests (global_rate and global_burst), 0 rate turns a limit off. Buckets of the least recently seen
+    accounts are dropped beyond max_accounts.
+    With store the limits are shared by processes: every sync_interval seconds tokens taken since the previous sync
+    are added to counters of the store and tokens taken by the other processes meanwhile are taken from local buckets.
+    Between syncs every process decides on its own, so the limits could be exceeded by usage of one interval"""
+
+    def __init__(self, account_rate=0, account_burst=0, global_rate=0, global_burst=0, max_accounts=10000,
+                 store=None, sync_interval=1):
+        self.account_rate = account_rate
+        self.account_burst = account_burst or account_rate
+        self.global_rate = global_rate
+        self.global_burst = global_burst or global_rate
+        self.buckets = LRUCache(max_entries=max_accounts)
+        self.global_bucket = TokenBucket(self.global_rate, self.global_burst, time.time())
+        self.lock = threading.Lock()
+        self.store = store
+        self.sync_interval = sync_interval
+        self.taken = {}
+        self.synced_totals = LRUCache(max_entries=max_accounts)
+        self.syncer = None
+        if store is not None:
+            if not store.has_counters:
+                raise ValueError("%s has no shared counters, rate limits can't be shared" % type(store).__name__)
+            self.stopping = threading.Event()
+            self.syncer = threading.Thread(target=self.run_syncer, name="RateLimitSync")
+            self.syncer.daemon = True
+            self.syncer.start()
+
+    def bucket(self, key, now):
+        bucket = self.global_bucket if key == GLOBAL else self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.account_rate, self.account_burst, now)
+            self.buckets.set(key, bucket)
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def admit(self, accounts):
+        """Takes a token of every account of the list (one per method request) and as many global tokens.
+        Returns None if all of them are available, nothing is taken otherwise and the exceeded limit is returned:
+        "account" or "global\""""
+        costs = {}
+        if self.account_rate:
+            for account in accounts:
+                key = "account:%s" % (account if isinstance(account, basestring) else "")
+                costs[key] = costs.get(key, 0) + 1
+        if self.global_rate:
+            costs[GLOBAL] = len(accounts)
+        if not costs:
+            return
+        now = time.time()
+        with self.lock:
+            buckets = [(key, self.bucket(key, now), cost) for key, cost in costs.iteritems()]
+            for key, bucket, cost in buckets:
+                if bucket.tokens < cost:
+                    limit = "global" if key == GLOBAL else "account"
+                    metrics.increment("rate_limited_%s_total" % limit)
+                    return limit
+            for key, bucket, cost in buckets:
+                bucket.spend(cost)
+                if self.syncer:
+                    self.taken[key] = self.taken.get(key, 0) + cost
+
+    def sync(self):
+        """adds local usage to counters of the store and subtracts usage of the others from local buckets"""
+        with self.lock:
+            taken, self.taken = self.taken, {}
+        if not taken:
+            return
+        totals = self.store.increment_counters(
+            dict((COUNTER_PREFIX + key, tokens) for key, tokens in taken.iteritems()),
+            expire=max(int(self.sync_interval * 10), 60))
+        if totals is None:
+            return
+        with self.lock:
+            for key, tokens in taken.iteritems():
+                total = totals[COUNTER_PREFIX + key]
+                previous = self.synced_totals.get(key)
+                others = total - previous - tokens if previous is not None else 0
+                self.synced_totals.set(key, total)
+                bucket = self.global_bucket if key == GLOBAL else self.buckets.get(key)
+                if bucket is not None and others > 0:
+                    bucket.spend(others)
+
+    def run_syncer(self):
+        while not self.stopping.wait(self.sync_interval):
+            try:
+                self.sync()
+            except Exception:
+                metrics.increment("rate_limit_sync_failures_total")
+
+    def close(self):
+        if self.syncer:
+            self.stopping.set()
+            self.syncer.join()
+            self.syncer = None
+
+
+def create_limiter(limits_config, store=None):
+    """limiter of 'option=value' config, the store is only used with shared=true"""
+    options = BaseStore.parse_config(limits_config)
+    shared = BaseStore.to_bool(options.get("shared", "false"))
+    return RateLimiter(account_rate=float(options.get("account_rate", 0)),
+                       account_burst=float(options.get("account_burst", 0)),
+                       global_rate=float(options.get("global_rate", 0)),
+                       global_burst=float(options.get("global_burst", 0)),
+                       max_accounts=int(options.get("max_accounts", 10000)),
+                       store=store if shared else None,
+                       sync_interval=float(options.get("sync_interval", 1)))
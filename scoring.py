@@ -1,7 +1,28 @@
+import array
+import hashlib
 import random
 
+numpy = None
+numpy_checked = False
+
+SCORE_TTL = 60 * 60
+INTERESTS = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+
+
+def get_score_key(phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+    key_parts = [unicode(part) if part is not None else u"" for part in
+                 (phone, email, birthday, gender, first_name, last_name)]
+    return "uid:" + hashlib.md5(u"|".join(key_parts).encode("utf-8")).hexdigest()
+
 
 def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    """score is cached in store for SCORE_TTL seconds, it's computed without store if the last is unavailable"""
+    key = get_score_key(phone, email, birthday, gender, first_name, last_name)
+    if store:
+        score = store.cached_get(key)
+        if score is not None:
+            return score
+
     score = 0
     if phone:
         score += 1.5
@@ -11,9 +32,50 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
+
+    if store:
+        store.cached_set(key, score, SCORE_TTL)
     return score
 
 
+def load_numpy():
+    """NumPy module or None if it isn't installed. It's imported by the first bulk scoring, so the server
+    importing this module never pays for it"""
+    global numpy, numpy_checked
+    if not numpy_checked:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        numpy_checked = True
+    return numpy
+
+
+def get_scores(phone, email, birthday, gender, first_name, last_name):
+    """scores of many customers in one pass. Arguments are columns of the same length with presence flags
+    (truthiness) of get_score arguments, NumPy arrays or any other sequences.
+    Scores are NumPy array of floats if NumPy is installed, array of doubles otherwise"""
+    if load_numpy() is not None:
+        phone, email, birthday, gender, first_name, last_name = [
+            numpy.asarray(column, dtype=bool) for column in (phone, email, birthday, gender, first_name, last_name)]
+        return 1.5 * phone + 1.5 * email + 1.5 * (birthday & gender) + 0.5 * (first_name & last_name)
+    return array.array("d", (1.5 * bool(p) + 1.5 * bool(e) + 1.5 * bool(b and g) + 0.5 * bool(f and l)
+                             for p, e, b, g, f, l in zip(phone, email, birthday, gender, first_name, last_name)))
+
+
 def get_interests(store, cid):
-    interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
-    return random.sample(interests, 2)
+    """interests of clients are kept in store under i:<client id>, unknown clients get random ones"""
+    if store:
+        interests = store.cached_get("i:%s" % cid)
+        if interests:
+            return interests
+    return random.sample(INTERESTS, 2)
+
+
+def get_interests_many(store, cids):
+    """same as get_interests for every client id, but store is asked once for all of them"""
+    stored = {}
+    if store:
+        keys = dict(("i:%s" % cid, cid) for cid in cids)
+        stored = dict((keys[key], interests) for key, interests in store.cached_get_many(list(keys)).iteritems())
+    return dict((cid, stored.get(cid) or random.sample(INTERESTS, 2)) for cid in cids)
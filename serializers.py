@@ -0,0 +1,100 @@
+import ast
+import json
+import marshal
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Serializer(object):
+    """Encoded value is prefixed with one byte tag, so stored records could be decoded whatever codec wrote them"""
+    tag = None
+
+    def dumps(self, value):
+        return self.tag + self.encode(value)
+
+    def loads(self, raw):
+        return self.decode(raw[1:])
+
+    def encode(self, value):
+        raise NotImplementedError
+
+    def decode(self, raw):
+        raise NotImplementedError
+
+
+class JSONSerializer(Serializer):
+    """JSON keeps only string keys, so digit keys (client ids) are turned back into integers"""
+    tag = "\x01"
+
+    def encode(self, value):
+        return json.dumps(value, separators=(",", ":"))
+
+    def decode(self, raw):
+        return json.loads(raw, object_hook=restore_int_keys)
+
+
+class MarshalSerializer(Serializer):
+    tag = "\x02"
+
+    def encode(self, value):
+        return marshal.dumps(value)
+
+    def decode(self, raw):
+        return marshal.loads(raw)
+
+
+class MsgpackSerializer(Serializer):
+    tag = "\x03"
+
+    def encode(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, raw):
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+class LiteralSerializer(Serializer):
+    """Migration reader for records written as python literals before the codecs were tagged"""
+    tag = ""
+
+    def encode(self, value):
+        return repr(value)
+
+    def decode(self, raw):
+        try:
+            return ast.literal_eval(raw)
+        except (ValueError, SyntaxError):
+            raise ValueError("Couldn't transform the string to dictionary")
+
+
+SERIALIZERS = {
+    "json": JSONSerializer(),
+    "marshal": MarshalSerializer(),
+    "literal": LiteralSerializer(),
+}
+if msgpack:
+    SERIALIZERS["msgpack"] = MsgpackSerializer()
+
+TAGGED = dict((s.tag, s) for s in SERIALIZERS.values() if s.tag)
+
+
+def get_serializer(name):
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError("Unknown serializer %s, available are: %s" % (name, ", ".join(sorted(SERIALIZERS))))
+
+
+def loads(raw):
+    """decodes a value of any known codec, untagged values are treated as legacy python literals"""
+    serializer = TAGGED.get(raw[:1])
+    if serializer is None:
+        return SERIALIZERS["literal"].decode(raw)
+    return serializer.loads(raw)
+
+
+def restore_int_keys(record):
+    return dict((int(k) if k.isdigit() else k, v) for k, v in record.iteritems())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import base64
+import marshal
+import logging
+from optparse import OptionParser
+
+import jsoncodec
+from BaseStore import BaseStore
+from RedisStore import RedisStore
+
+FORMATS = ("jsonl", "binary")
+COMMANDS = ("export", "import")
+
+
+def encode_entry(entry):
+    """JSON line of exported entry, keys, field names and values are raw bytes, so all of them are base64 encoded"""
+    key, key_type, ttl, value = entry
+    if key_type == "hash":
+        value = dict((base64.b64encode(field), base64.b64encode(raw)) for field, raw in value.iteritems())
+    else:
+        value = base64.b64encode(value)
+    return jsoncodec.dumps({"key": base64.b64encode(key), "type": key_type, "ttl": ttl, "value": value}) + "\n"
+
+
+def decode_entry(line):
+    entry = jsoncodec.loads(line)
+    value = entry["value"]
+    if entry["type"] == "hash":
+        value = dict((base64.b64decode(field), base64.b64decode(raw)) for field, raw in value.iteritems())
+    else:
+        value = base64.b64decode(value)
+    return base64.b64decode(entry["key"]), str(entry["type"]), entry["ttl"], value
+
+
+def write_batch(f, entries, fmt):
+    """jsonl has a line per key, binary has one marshal encoded list per batch"""
+    if fmt == "binary":
+        marshal.dump(entries, f)
+    else:
+        f.write("".join(encode_entry(entry) for entry in entries))
+
+
+def read_batches(f, fmt, batch_size):
+    """yields (entries, offset of the file after them), so import could be resumed from the offset"""
+    if fmt == "binary":
+        while True:
+            try:
+                entries = marshal.load(f)
+            except EOFError:
+                return
+            yield [tuple(entry) for entry in entries], f.tell()
+    entries = []
+    while True:
+        line = f.readline()
+        if line.strip():
+            entries.append(decode_entry(line))
+        if entries and (len(entries) >= batch_size or not line):
+            yield entries, f.tell()
+            entries = []
+        if not line:
+            return
+
+
+def read_checkpoint(path):
+    if path and os.path.exists(path):
+        return BaseStore.parse_config(path)
+    return {}
+
+
+def write_checkpoint(path, **values):
+    """checkpoint is replaced atomically, so it's never seen half written"""
+    with open(path + ".tmp", "w") as f:
+        f.write("".join("%s=%s\n" % item for item in sorted(values.items())))
+    os.rename(path + ".tmp", path)
+
+
+def export_store(store, f, fmt="jsonl", batch_size=500, checkpoint=None):
+    """Writes all keys of the store into f batch by batch. With checkpoint file the cursor of the scan and
+    the size of written output are saved after every batch, export started again truncates output to that size
+    and continues from the cursor, the first one truncates whatever the file had. Returns number of exported keys"""
+    state = read_checkpoint(checkpoint)
+    if state.get("cursor") == "done":
+        return 0
+    if checkpoint:
+        f.seek(int(state.get("offset", 0)))
+        f.truncate()
+    exported = 0
+    for cursor, entries in store.export_batches(state.get("cursor"), batch_size):
+        if entries:
+            write_batch(f, entries, fmt)
+            exported += len(entries)
+        if checkpoint:
+            f.flush()
+            write_checkpoint(checkpoint, cursor=cursor or "done", offset=f.tell())
+    return exported
+
+
+def import_store(store, f, fmt="jsonl", batch_size=500, checkpoint=None):
+    """Writes exported keys into the store batch by batch. With checkpoint file the offset of the input
+    after the last written batch is saved, import started again continues from there. Returns number of imported keys"""
+    state = read_checkpoint(checkpoint)
+    if state:
+        f.seek(int(state["offset"]))
+    imported = 0
+    for entries, offset in read_batches(f, fmt, batch_size):
+        written = store.import_entries(entries)
+        if written is None:
+            raise IOError("Redis is unavailable, %s keys are imported" % imported)
+        imported += written
+        if checkpoint:
+            write_checkpoint(checkpoint, offset=offset)
+    return imported
+
+
+def main(opts, command, path):
+    store = RedisStore(db_config=opts.store_config, flush_interval=0, startup="keep", logger=logging)
+    fmt = opts.format or ("binary" if path and path.endswith(".bin") else "jsonl")
+    if command == "export":
+        with (open(path, "ab+" if opts.checkpoint else "wb") if path else sys.stdout) as f:
+            count = export_store(store, f, fmt, opts.batch_size, opts.checkpoint)
+    else:
+        with (open(path, "rb") if path else sys.stdin) as f:
+            count = import_store(store, f, fmt, opts.batch_size, opts.checkpoint)
+    logging.info("%s keys are %sed" % (count, command))
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] export|import [file]\n"
+                            "Exports keys of redis store into file or imports them, stdout and stdin by default")
+    op.add_option("-s", "--store_config", default=None)
+    op.add_option("-f", "--format", action="store", type="choice", choices=FORMATS, default=None,
+                  help="format of the file, by default binary for .bin files and jsonl otherwise")
+    op.add_option("-b", "--batch_size", action="store", type=int, default=500)
+    op.add_option("-c", "--checkpoint", default=None,
+                  help="file of progress, interrupted export or import with the same checkpoint continues from it")
+    (opts, args) = op.parse_args()
+    if not 1 <= len(args) <= 2 or args[0] not in COMMANDS:
+        op.error("export or import command is expected")
+    if opts.checkpoint and len(args) < 2:
+        op.error("checkpoint needs a file")
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname).1s %(message)s",
+                        datefmt="%Y.%m.%d %H:%M:%S")
+    main(opts, args[0], args[1] if len(args) == 2 else None)
@@ -2,10 +2,31 @@
 import hashlib
 import datetime
 import functools
+import httplib
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
 import unittest
 
+import BaseStore
+import MemoryStore
 import RedisStore
+import SQLiteStore
 import api
+import asynclog
+import batch_score
+import cache
+import hashring
+import jsoncodec
+import metrics
+import ratelimit
+import scoring
+import serializers
+import store_dump
 
 
 def cases(cases_):
@@ -23,9 +44,11 @@ class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {}
         self.headers = {}
-        self.store = RedisStore.RedisStore()
+        self.store = RedisStore.RedisStore(flush_interval=0)
+        api.RESULT_CACHE.clear()
 
     def tearDown(self):
+        self.store.close()
         self.store.destroy_store()
 
     def get_response(self, request):
@@ -78,11 +101,16 @@ class TestSuite(unittest.TestCase):
         {"phone": "79175002040", "email": "stupnikov@otus.ru", "gender": "1"},
         {"phone": "79175002040", "email": "stupnikov@otus.ru", "gender": 1, "birthday": "01.01.1890"},
         {"phone": "79175002040", "email": "stupnikov@otus.ru", "gender": 1, "birthday": "XXX"},
+        {"phone": "79175002040", "email": "stupnikov@otus.ru", "gender": 1, "birthday": "31.02.2000"},
         {"phone": "79175002040", "email": "stupnikov@otus.ru", "gender": 1, "birthday": "01.01.2000", "first_name": 1},
         {"phone": "79175002040", "email": "stupnikov@otus.ru", "gender": 1, "birthday": "01.01.2000",
          "first_name": "s", "last_name": 2},
         {"phone": "79175002040", "birthday": "01.01.2000", "first_name": "s"},
         {"email": "stupnikov@otus.ru", "gender": 1, "last_name": 2},
+        {"phone": "", "email": ""},
+        {"first_name": "", "last_name": None},
+        {"gender": 1, "birthday": "01.01.2000\n"},
+        {"gender": 1, "birthday": "01.1.20000"},
     ])
     def test_invalid_score_request(self, arguments):
         request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments}
@@ -98,6 +126,7 @@ class TestSuite(unittest.TestCase):
         {"gender": 0, "birthday": "01.01.1991"},
         {"gender": 2, "birthday": "01.01.1991"},
         {"first_name": "a", "last_name": "b"},
+        {"gender": 1, "birthday": "1.1.2000"},
         {"phone": "70000000000", "email": "post@yahoo.com", "gender": 1, "birthday": "01.01.1991",
          "first_name": "a", "last_name": "b"},
     ])
@@ -131,6 +160,11 @@ class TestSuite(unittest.TestCase):
          "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c"
                   "03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
          "arguments": {}},
+
+        {"account": "horns&hoofs", "method": "online_score",
+         "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c"
+                  "03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
+         "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}},
     ])
     def test_empty_request(self, request):
         _, code = self.get_response(request)
@@ -183,9 +217,672 @@ class TestSuite(unittest.TestCase):
     ])
     def test_update_db(self, given, expected):
         self.store.update_db(test_account=given)
-        got = RedisStore.RedisStore.convert_str_to_dict(self.store.get("test_account"))
+        got = self.store.get("test_account")
         self.assertEqual(got, expected)
 
+    def test_update_db_many_records(self):
+        self.store.update_db(first_account={"score": 1.5})
+        self.store.update_db(first_account={1: ['tv', 'it']}, second_account={"score": 3.0})
+        first = self.store.get("first_account")
+        second = self.store.get("second_account")
+        self.assertEqual(first, {"score": 1.5, 1: ['tv', 'it']})
+        self.assertEqual(second, {"score": 3.0})
+
+    @cases(sorted(serializers.SERIALIZERS))
+    def test_serializers_round_trip(self, name):
+        record = {"score": 3.5, 1: ['cinema', 'tv'], 20: ['it', 'hi-tech']}
+        serializer = serializers.get_serializer(name)
+        self.assertEqual(serializers.loads(serializer.dumps(record)), record)
+
+    def test_legacy_record_migration(self):
+        legacy = {"score": 5.0, 1: ['cinema', 'tv']}
+        self.store.db.set(self.store.key("legacy_account"), repr(legacy))
+        self.assertEqual(self.store.get("legacy_account"), legacy)
+        self.store.record_format = "hash"
+        self.store.migrate_records()
+        self.store.update_db(legacy_account={2: ['it', 'pets']})
+        self.assertEqual(self.store.get("legacy_account"), {"score": 5.0, 1: ['cinema', 'tv'], 2: ['it', 'pets']})
+
+    def test_cache_accounts_nested_records(self):
+        self.store.max_cache_size = 10 ** 6
+        self.store.update_cache("test_account", {1: ['cinema', 'tv']})
+        size = self.store.get_cache_size()
+        self.store.update_cache("test_account", {2: ['it', 'hi-tech'] * 50})
+        self.assertGreater(self.store.get_cache_size() - size, 100 * 30)
+        self.store.update_cache("test_account", {2: ['it']})
+        self.assertLess(self.store.get_cache_size() - size, 200)
+
+    def test_cache_flush_and_eviction(self):
+        self.store.max_cache_size = 10 ** 6
+        self.store.update_cache("first_account", {"score": 1.0})
+        self.store.update_cache("second_account", {"score": 2.0})
+        self.assertEqual(self.store.get("first_account"), None)
+        self.store.max_cache_size = 1
+        self.store.update_cache("third_account", {"score": 3.0})
+        self.assertEqual(self.store.get("first_account"), {"score": 1.0})
+        self.assertEqual(self.store.get("third_account"), {"score": 3.0})
+        self.assertEqual(list(self.store.get_cache().entries), ["third_account"])
+        self.assertEqual(self.store.cache_get("third_account"), {"score": 3.0})
+        self.assertEqual(self.store.cache_get("first_account"), None)
+        stats = self.store.cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["flushes"], stats["evictions"]), (1, 4, 1, 2))
+
+    def test_cache_eviction_of_dirty_records(self):
+        records_cache = cache.WriteBehindCache(max_size=1)
+        for i in range(3):
+            records_cache.update("account_%s" % i, {"score": float(i)})
+        records_cache.evict()
+        self.assertEqual((len(records_cache), len(records_cache.clean), records_cache.evictions), (3, 0, 0))
+        records, versions = records_cache.take_dirty()
+        records_cache.update("account_0", {"score": 5.0})
+        records_cache.mark_clean(versions)
+        self.assertEqual(list(records_cache.clean), ["account_1", "account_2"])
+        records_cache.evict()
+        self.assertEqual(list(records_cache.entries), ["account_0"])
+        self.assertEqual((len(records_cache.clean), records_cache.evictions), (0, 2))
+
+    def test_watch_conflicts(self):
+        store = self.store
+        serializer = store.serializer
+
+        class ConflictingSerializer(object):
+            def dumps(self, value):
+                store.db.set(store.key("test_account"), serializer.dumps({"score": 0.0}))
+                return serializer.dumps(value)
+
+        store.max_cache_size = 10 ** 6
+        store.update_cache("test_account", {1: ["tv"]})
+        store.serializer = ConflictingSerializer()
+        self.assertFalse(store.flush_cache())
+        self.assertEqual(store.cache_stats()["dirty"], 1)
+        store.serializer = serializer
+        self.assertTrue(store.flush_cache())
+        self.assertEqual(store.get("test_account"), {"score": 0.0, 1: ["tv"]})
+
+    def test_cache_age_flush(self):
+        self.store.max_cache_size = 10 ** 6
+        self.store.cache.max_age = 0.01
+        self.store.update_cache("test_account", {"score": 1.0})
+        time.sleep(0.02)
+        self.store.update_cache("test_account", {"score": 2.0})
+        self.assertEqual(self.store.get("test_account"), {"score": 2.0})
+        self.assertEqual(self.store.cache_stats()["dirty"], 0)
+
+    def test_background_flush(self):
+        store = RedisStore.RedisStore(flush_interval=0.01, max_cache_size=10 ** 6)
+        store.update_cache("test_account", {"score": 1.0})
+        self.assertEqual(store.cache_stats()["dirty"], 1)
+        time.sleep(0.1)
+        self.assertEqual(store.get("test_account"), {"score": 1.0})
+        store.update_cache("test_account", {"score": 2.0})
+        store.close()
+        self.assertEqual(store.get("test_account"), {"score": 2.0})
+        self.assertEqual(store.cache_stats()["dirty"], 0)
+
+    def test_score_read_through_cache(self):
+        arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
+        self.assertEqual(scoring.get_score(self.store, **arguments), 3.0)
+        key = scoring.get_score_key(**arguments)
+        self.assertEqual(self.store.get_value(key), self.store.serializer.dumps(3.0))
+        self.store.local.clear()
+        self.assertEqual(scoring.get_score(self.store, **arguments), 3.0)
+        self.assertEqual(self.store.local_cache_stats()["misses"], 2)
+        self.assertEqual(scoring.get_score(self.store, **arguments), 3.0)
+        self.assertEqual(self.store.local_cache_stats()["hits"], 1)
+        self.assertEqual(scoring.get_score(None, **arguments), 3.0)
+
+    def test_interests_from_store(self):
+        self.store.cached_set("i:1", ["books", "tv"])
+        self.store.local.clear()
+        self.assertEqual(scoring.get_interests(self.store, 1), ["books", "tv"])
+        self.assertEqual(len(scoring.get_interests(self.store, 2)), 2)
+
+    def test_local_cache_ttl(self):
+        self.store.cached_set("i:1", ["books", "tv"])
+        self.store.flush_cache()
+        self.store.local.clear()
+        self.store.local.ttl = 0.01
+        self.assertEqual(self.store.cached_get("i:1"), ["books", "tv"])
+        self.assertEqual(self.store.local.get("i:1"), ["books", "tv"])
+        time.sleep(0.02)
+        self.assertIsNone(self.store.local.get("i:1"))
+        self.assertEqual(self.store.cached_get_many(["i:1"]), {"i:1": ["books", "tv"]})
+        self.assertEqual(self.store.local.get("i:1"), ["books", "tv"])
+        time.sleep(0.02)
+        self.assertIsNone(self.store.local.get("i:1"))
+
+    def test_interests_many_from_store(self):
+        self.store.cached_set("i:1", ["books", "tv"])
+        self.store.cached_set("i:3", ["it", "pets"])
+        self.store.local.clear()
+        self.store.cached_get("i:3")
+        interests = scoring.get_interests_many(self.store, [1, 2, 3])
+        self.assertEqual(sorted(interests), [1, 2, 3])
+        self.assertEqual(interests[1], ["books", "tv"])
+        self.assertEqual(interests[3], ["it", "pets"])
+        self.assertEqual(len(interests[2]), 2)
+        self.assertEqual(self.store.local_cache_stats()["hits"], 1)
+
+    @cases([False, True])
+    def test_batch_request(self, parallel):
+        score_request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                         "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        interests_request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                             "arguments": {"client_ids": [1, 2]}}
+        self.set_valid_auth(score_request)
+        self.set_valid_auth(interests_request)
+        bad_auth_request = dict(score_request, token="+++")
+        invalid_request = dict(score_request, arguments={"phone": "79175002040"})
+        body = {"requests": [score_request, interests_request, bad_auth_request, invalid_request, []],
+                "parallel": parallel}
+        response, code = api.batch_handler({"body": body, "headers": self.headers}, self.context, self.store)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([item["code"] for item in response],
+                         [api.OK, api.OK, api.FORBIDDEN, api.INVALID_REQUEST, api.INVALID_REQUEST])
+        self.assertEqual(response[0]["response"], {"score": 3.0})
+        self.assertEqual(sorted(response[1]["response"]), [1, 2])
+        self.assertEqual(sorted(self.store.cache_get("horns&hoofs")), [1, 2, "score"])
+        if parallel:
+            pool = api.get_batch_pool()
+            api.batch_handler({"body": body, "headers": self.headers}, self.context, self.store)
+            self.assertTrue(api.get_batch_pool() is pool)
+
+    @cases([[], {}, "online_score", {"requests": {}}])
+    def test_invalid_batch_request(self, body):
+        _, code = api.batch_handler({"body": body, "headers": self.headers}, self.context, self.store)
+        self.assertEqual(api.INVALID_REQUEST, code)
+
+    def test_auth_cache(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        self.set_valid_auth(request)
+        admin_request = dict(request, login=api.ADMIN_LOGIN)
+        self.set_valid_auth(admin_request)
+        stats = api.AUTH_CACHE.stats()
+        for _ in range(3):
+            api.RESULT_CACHE.clear()
+            self.assertEqual(self.get_response(request)[1], api.OK)
+            self.assertEqual(self.get_response(admin_request)[1], api.OK)
+            self.assertEqual(self.get_response(dict(request, token=unicode(request["token"][:-1])))[1],
+                             api.FORBIDDEN)
+        new_stats = api.AUTH_CACHE.stats()
+        self.assertGreaterEqual(new_stats["hits"] - stats["hits"], 5)
+        self.assertGreaterEqual(new_stats["admin_hits"] - stats["admin_hits"], 2)
+        self.assertEqual(self.get_response(dict(request, login=None))[1], api.FORBIDDEN)
+        text = metrics.render(auth_cache=api.AUTH_CACHE)
+        self.assertIn("scoring_auth_cache_hits_total %s\n" % new_stats["hits"], text)
+        self.assertIn("# TYPE scoring_auth_cache_entries gauge", text)
+
+    def test_circuit_breaker(self):
+        breaker = RedisStore.CircuitBreaker(failure_threshold=2, reset_timeout=0.01)
+        self.assertFalse(breaker.failure())
+        self.assertTrue(breaker.failure())
+        self.assertFalse(breaker.allow())
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        self.assertTrue(breaker.failure())
+        self.assertEqual((breaker.state, breaker.reset_timeout), (breaker.OPEN, 0.02))
+        time.sleep(0.03)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual((breaker.state, breaker.reset_timeout), (breaker.CLOSED, 0.01))
+
+    def test_breaker_probe_error(self):
+        store = RedisStore.RedisStore(flush_interval=0, breaker_reset_timeout=0.01)
+        store.update_db(good={"score": 1.0})
+        store.db.set(store.key("bad"), store.serializer.tag + "garbage")
+        self.assertTrue(store.breaker.failure())
+        time.sleep(0.02)
+        self.assertRaises((ValueError, EOFError), store.get, "bad")
+        self.assertEqual(store.breaker_state(), RedisStore.CircuitBreaker.CLOSED)
+        self.assertEqual(store.get("good"), {"score": 1.0})
+        store.destroy_store()
+
+    def test_unavailable_store(self):
+        store = RedisStore.RedisStore(port=1, flush_interval=0, backoff=0.001, breaker_reset_timeout=10)
+        self.assertEqual(store.get("horns&hoofs"), None)
+        self.assertEqual(store.breaker_state(), RedisStore.CircuitBreaker.OPEN)
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        self.set_valid_auth(request)
+        store.max_cache_size = 1
+        response, code = api.method_handler({"body": request, "headers": self.headers}, self.context, store)
+        self.assertEqual((response, code), ({"score": 3.0}, api.OK))
+        self.assertEqual(store.cache_stats()["dirty"], 1)
+        store.max_dirty = 3
+        store.ready.clear()
+        for i in range(5):
+            store.cached_set("uid:%s" % i, float(i))
+        store.cached_set("uid:0", 5.0)
+        store.ready.set()
+        self.assertFalse(store.flush_cache())
+        self.assertEqual((len(store.pending_values), store.stats()["dropped_values_total"]), (3, 2))
+        self.assertEqual(store.pending_values["uid:0"][0], store.serializer.dumps(5.0))
+        self.assertFalse(store.close())
+
+    def test_store_startup(self):
+        self.store.update_db(test_account={"score": 1.0})
+        kept_store = RedisStore.RedisStore(flush_interval=0)
+        self.assertEqual(kept_store.get("test_account"), {"score": 1.0})
+        other_store = RedisStore.RedisStore(flush_interval=0, key_prefix="other:", startup="reset")
+        other_store.ready.wait()
+        self.assertEqual(kept_store.get("test_account"), {"score": 1.0})
+        reset_store = RedisStore.RedisStore(flush_interval=0, startup="reset")
+        reset_store.update_cache("test_account", {1: ["tv", "it"]})
+        reset_store.ready.wait()
+        self.assertTrue(reset_store.close())
+        self.assertEqual(kept_store.get("test_account"), {1: ["tv", "it"]})
+        down_store = RedisStore.RedisStore(port=1, flush_interval=0, backoff=0.001, max_backoff=0.01, startup="reset")
+        self.assertFalse(down_store.ready.wait(0.1))
+        self.assertFalse(down_store.close())
+        self.assertFalse(down_store.ready.is_set())
+
+    def test_hash_ring(self):
+        ring = hashring.HashRing(["first", "second", "third"])
+        keys = ["account%s" % i for i in range(3000)]
+        owners = dict((key, ring.get_node(key)) for key in keys)
+        self.assertTrue(all(600 < owners.values().count(node) < 1400 for node in ring.nodes))
+        ring.add_node("fourth")
+        moved = [key for key in keys if ring.get_node(key) != owners[key]]
+        self.assertTrue(all(ring.get_node(key) == "fourth" for key in moved))
+        self.assertTrue(500 < len(moved) < 1100)
+
+    def test_sharded_store(self):
+        store = RedisStore.RedisStore(flush_interval=0, max_cache_size=10 ** 6, key_prefix="sharded:",
+                                      nodes="localhost:6379:1,localhost:6379:2")
+        records = dict(("account%s" % i, {"score": float(i)}) for i in range(100))
+        for key, record in records.iteritems():
+            store.update_cache(key, record)
+        self.assertTrue(store.flush_cache())
+        store.cached_set("i:1", ["books", "tv"])
+        self.assertTrue(all(client.dbsize() > 20 for client in store.nodes.values()))
+        move_keys = store.move_keys
+        failures = []
+
+        def fail_once(*args):
+            if not failures:
+                failures.append(1)
+                raise RedisStore.redis.exceptions.ConnectionError()
+            return move_keys(*args)
+        store.move_keys = fail_once
+        store.backoff = 0
+        self.assertTrue(store.add_node("localhost:6379:3") > 10)
+        self.assertEqual(failures, [1])
+        self.assertEqual(store.rebalance(), 0)
+        store.local.clear()
+        self.assertEqual(store.cached_get_many(["i:1"]), {"i:1": ["books", "tv"]})
+        self.assertTrue(all(store.get(key) == record for key, record in records.iteritems()))
+        store.destroy_store()
+        self.assertTrue(all(client.dbsize() == 0 for client in store.nodes.values()))
+
+    def test_move_keys_merge(self):
+        store = RedisStore.RedisStore(flush_interval=0, key_prefix="move:", nodes="localhost:6379:1")
+        source, target = store.db, store.connect("localhost:6379:2")
+        source.set("move:a", store.serializer.dumps({"score": 1.0, 1: ["tv"]}))
+        target.set("move:a", store.serializer.dumps({"score": 2.0}))
+        source.set("move:i:1", store.serializer.dumps(["tv"]))
+        target.set("move:i:1", store.serializer.dumps(["books"]))
+        self.assertEqual(store.move_keys(source, target, ["move:a", "move:i:1"]), 2)
+        self.assertEqual(store.convert_str_to_dict(target.get("move:a")), {"score": 2.0, 1: ["tv"]})
+        self.assertEqual(store.convert_str_to_dict(target.get("move:i:1")), ["books"])
+        self.assertEqual(source.dbsize(), 0)
+        target.delete("move:a", "move:i:1")
+
+    @cases(["jsonl", "binary"])
+    def test_store_dump(self, fmt):
+        source = RedisStore.RedisStore(flush_interval=0, max_cache_size=10 ** 6, key_prefix="export:",
+                                       nodes="localhost:6379:1,localhost:6379:2")
+        target = RedisStore.RedisStore(flush_interval=0, key_prefix="import:", record_format="hash")
+        records = dict(("account%s" % i, {"score": float(i), i: ["tv"]}) for i in range(49))
+        records["\xd1\x80\xd0\xbe\xd0\xb3\xd0\xb0"] = {"score": 2.0, 1: ["\xd0\xba\xd0\xb8\xd0\xbd\xd0\xbe"]}
+        source.update_db(**records)
+        source.write_values({"i:1": (source.serializer.dumps(["books"]), 3600)})
+        path = os.path.join(tempfile.mkdtemp(), "dump")
+        checkpoint = path + ".checkpoint"
+        export_batches = source.export_batches
+        source.export_batches = lambda cursor, batch_size: itertools.islice(export_batches(cursor, batch_size), 2)
+        with open(path, "w") as f:
+            f.write("stale line\n")
+        with open(path, "ab+") as f:
+            store_dump.export_store(source, f, fmt, batch_size=5, checkpoint=checkpoint)
+        self.assertTrue(store_dump.read_checkpoint(checkpoint)["cursor"].startswith("localhost:6379:1/"))
+        source.export_batches = export_batches
+        with open(path, "ab+") as f:
+            self.assertTrue(0 < store_dump.export_store(source, f, fmt, batch_size=5, checkpoint=checkpoint) < 51)
+            self.assertEqual(store_dump.export_store(source, f, fmt, batch_size=5, checkpoint=checkpoint), 0)
+        with open(path, "rb") as f:
+            self.assertEqual(store_dump.import_store(target, f, fmt, batch_size=7), 51)
+        self.assertTrue(all(target.get(key) == record for key, record in records.iteritems()))
+        self.assertEqual(serializers.loads(target.get_value("i:1")), ["books"])
+        self.assertTrue(0 < target.db.ttl("import:i:1") <= 3600)
+        self.assertEqual(target.db.ttl("import:account1"), -1)
+        source.destroy_store()
+        target.destroy_store()
+
+    @cases([
+        lambda: MemoryStore.MemoryStore(flush_interval=0, shards=4),
+        lambda: SQLiteStore.SQLiteStore(flush_interval=0, path=os.path.join(tempfile.mkdtemp(), "test.db")),
+    ])
+    def test_store_backends(self, make_store):
+        store = make_store()
+        store.update_cache("test_account", {"score": 1.5, 1: ["tv"]})
+        store.update_cache("test_account", {2: ["cars"]})
+        self.assertTrue(store.flush_cache())
+        store.update_db(test_account={1: ["books"]})
+        self.assertEqual(store.get("test_account"), {"score": 1.5, 1: ["books"], 2: ["cars"]})
+        self.assertIsNone(store.get("missing_account"))
+        store.cached_set("i:1", ["books", "tv"])
+        store.cached_set("uid:1", 3.0, expire=-1)
+        store.local.clear()
+        self.assertEqual(store.cached_get("i:1"), ["books", "tv"])
+        self.assertEqual(store.cached_get_many(["i:1", "i:2", "uid:1"]), {"i:1": ["books", "tv"]})
+        self.assertEqual(scoring.get_interests_many(store, [1]), {1: ["books", "tv"]})
+        store.destroy_store()
+        self.assertIsNone(store.get("test_account"))
+        store.close()
+
+    def test_create_store(self):
+        config = os.path.join(tempfile.mkdtemp(), "store.config")
+        with open(config, "w") as f:
+            f.write("backend=memory\nshards=2\nflush_interval=0")
+        store = BaseStore.create_store(db_config=config, startup="keep")
+        self.assertIsInstance(store, MemoryStore.MemoryStore)
+        self.assertEqual(len(store.shards), 2)
+        with open(config, "w") as f:
+            f.write("backend=unknown")
+        self.assertRaises(ValueError, BaseStore.create_store, db_config=config)
+
+    def test_metrics(self):
+        histogram = metrics.Histogram("test_seconds", "Test", "phase", buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 3):
+            histogram.observe("read", value)
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{phase="read",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{phase="read",le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{phase="read",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{phase="read"} 4', lines)
+
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        self.set_valid_auth(request)
+        self.get_response(request)
+        text = metrics.render(self.store)
+        for phase in ("validation", "auth", "handler", "store_update"):
+            self.assertIn('scoring_phase_seconds_count{phase="%s"}' % phase, text)
+        self.assertIn("scoring_store_cache_hits_total ", text)
+        self.assertNotIn("scoring_store_cache_misses_total 0\n", text)
+        self.assertIn("scoring_store_circuit_state 0", text)
+
+    def test_async_logging(self):
+        class ListHandler(logging.Handler):
+            lines = []
+
+            def emit(self, record):
+                self.lines.append(self.format(record))
+
+        target = ListHandler()
+        target.setFormatter(asynclog.JSONFormatter(max_length=20))
+        handler = asynclog.AsyncHandler(target)
+        handler.addFilter(asynclog.SamplingFilter(0.5))
+        logger = logging.getLogger("test_async_logging")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        context = {"request_id": "1", "code": 200, "response": {"client_ids": range(100)}}
+        logger.info("%s: %s", "/method/", "x" * 100, extra={"request_id": "2"})
+        logger.info(context, extra={"request_id": "2"})
+        for request_id in map(str, range(100)):
+            logger.info("request", extra={"request_id": request_id})
+            logger.info("context", extra={"request_id": request_id})
+        logger.warning("always kept", extra={"request_id": "0"})
+        handler.close()
+        logger.removeHandler(handler)
+
+        entries = [json.loads(line) for line in target.lines]
+        self.assertEqual(entries[0]["message"], "/method/: xxxxxxxxxx... (90 more)")
+        self.assertEqual(entries[1]["code"], 200)
+        self.assertTrue(entries[1]["response"].startswith('{"client_ids": [0, 1') and
+                        entries[1]["response"].endswith("more)"))
+        self.assertEqual(entries[-1]["message"], "always kept")
+        sampled = [entry["request_id"] for entry in entries[2:-1]]
+        self.assertTrue(20 < len(sampled) < 180)
+        self.assertEqual(sampled[::2], sampled[1::2])
+        self.assertEqual(asynclog.truncate("x" * 30, 20), "x" * 20 + "... (10 more)")
+        text = asynclog.TextFormatter(max_length=10).format(logging.makeLogRecord({"msg": "%s", "args": ("y" * 15,)}))
+        self.assertTrue(text.endswith("y" * 10 + "... (5 more)"))
+
+    @cases([
+        {"response": dict((cid, ["cars", u"кино"]) for cid in range(100)), "code": 200},
+        [{"response": {"score": 3.0}, "code": 200}, {"error": "Forbidden", "code": 403}],
+        {"error": "Invalid Request", "code": 422},
+    ])
+    def test_streaming_encoder(self, body):
+        chunks = list(jsoncodec.iterencode(body, chunk_size=100))
+        self.assertEqual(json.loads("".join(chunks)), json.loads(json.dumps(body)))
+        self.assertEqual(json.loads(jsoncodec.dumps(body)), json.loads(json.dumps(body)))
+        self.assertTrue(all(len(chunk) < 200 for chunk in chunks))
+
+    def test_keep_alive(self):
+        self.assertEqual(api.main_http_handler_with_store().keepalive_timeout, 0)
+        handler = api.main_http_handler_with_store(self.store, keepalive_timeout=5, max_keepalive_requests=3,
+                                                   gzip_min_size=10 ** 6)
+        server = api.ThreadPoolHTTPServer(("127.0.0.1", 0), handler, workers=2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        connection = httplib.HTTPConnection(*server.server_address)
+        try:
+            sockets = []
+            for nclients in (1, 2000, 3):
+                request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                           "arguments": {"client_ids": range(nclients), "date": "20.05.2018"}}
+                self.set_valid_auth(request)
+                connection.request("POST", "/method/", json.dumps(request))
+                sockets.append(connection.sock)
+                response = connection.getresponse()
+                self.assertEqual(len(json.loads(response.read())["response"]), nclients)
+                self.assertEqual(response.getheader("transfer-encoding"), "chunked" if nclients > 1000 else None)
+                self.assertEqual(response.getheader("connection"), "close" if len(sockets) == 3 else None)
+            self.assertTrue(sockets[0] is sockets[1] is sockets[2])
+            self.assertIsNone(connection.sock)
+        finally:
+            connection.close()
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_rate_limits(self):
+        limiter = ratelimit.RateLimiter(account_rate=0.001, account_burst=2, global_rate=1000)
+        self.assertEqual([limiter.admit(["a"]) for _ in range(3)], [None, None, "account"])
+        self.assertIsNone(limiter.admit(["b"]))
+        self.assertEqual(limiter.admit(["c", "c", "c"]), "account")
+        self.assertIsNone(limiter.admit(["c", "c"]))
+        limiter = ratelimit.RateLimiter(global_rate=0.001, global_burst=3)
+        self.assertEqual([limiter.admit(["a", "b"]), limiter.admit(["c", "d"]), limiter.admit([None])],
+                         [None, "global", None])
+
+        sqlite_store = SQLiteStore.SQLiteStore(flush_interval=0, path=os.path.join(tempfile.mkdtemp(), "test.db"))
+        for store in (self.store, sqlite_store):
+            first, second = [ratelimit.RateLimiter(account_rate=0.001, account_burst=4, store=store,
+                                                   sync_interval=3600) for _ in range(2)]
+            try:
+                for limiter, accounts in ((first, ["x"]), (second, ["x"]), (first, ["x", "x"])):
+                    self.assertIsNone(limiter.admit(accounts))
+                    limiter.sync()
+                self.assertEqual(first.admit(["x"]), "account")
+                self.assertIsNone(second.admit(["x"]))
+            finally:
+                first.close()
+                second.close()
+                store.destroy_store()
+        self.assertEqual(sqlite_store.increment_counters({"a": 2}, expire=-1), {"a": 2})
+        self.assertEqual(sqlite_store.increment_counters({"a": 1, "b": 1}), {"a": 1, "b": 1})
+        sqlite_store.close()
+        memory_store = MemoryStore.MemoryStore(flush_interval=0)
+        self.assertRaises(ValueError, ratelimit.RateLimiter, account_rate=1, store=memory_store)
+
+    def test_admission_control(self):
+        limiter = ratelimit.RateLimiter(account_rate=0.001, account_burst=1)
+        handler = api.main_http_handler_with_store(self.store, limiter=limiter)
+        server = api.ThreadPoolHTTPServer(("127.0.0.1", 0), handler, workers=1, queue_size=1, shed_load=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            codes = []
+            for account in ("horns&hoofs", "horns&hoofs", "other"):
+                connection = httplib.HTTPConnection(*server.server_address)
+                connection.request("POST", "/method/", json.dumps({"account": account, "method": "online_score"}))
+                codes.append(json.loads(connection.getresponse().read())["code"])
+                connection.close()
+            self.assertEqual(codes, [api.INVALID_REQUEST, api.TOO_MANY_REQUESTS, api.INVALID_REQUEST])
+
+            server.queue_timeout = 0.01
+            server.requests.put((None, None, None))
+            server.workers[0].join()
+            waiting = httplib.HTTPConnection(*server.server_address)
+            waiting.request("POST", "/method/", "{}")
+            shed = httplib.HTTPConnection(*server.server_address)
+            shed.request("POST", "/method/", "{}")
+            response = shed.getresponse()
+            self.assertEqual((response.status, json.loads(response.read())["code"]), (503, 503))
+            time.sleep(0.05)
+            server.workers[0] = threading.Thread(target=server.process_queue)
+            server.workers[0].start()
+            self.assertEqual(waiting.getresponse().status, 503)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_background_store_startup(self):
+        config = os.path.join(tempfile.mkdtemp(), "store.config")
+        with open(config, "w") as f:
+            f.write("backend='memory'\nflush_interval=0\n")
+        self.assertEqual(BaseStore.BaseStore.parse_config(config), {"backend": "memory", "flush_interval": "0"})
+        self.assertEqual(BaseStore.BaseStore.parse_config("store.config")["host"], "localhost")
+        self.assertTrue(BaseStore.BaseStore.parse_config(config) is not BaseStore.BaseStore.parse_config(config))
+        server = api.ThreadPoolHTTPServer(("127.0.0.1", 0), api.main_http_handler_with_store(), workers=1)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        wait_fd, release_fd = os.pipe()
+        connector = None
+
+        def get_statuses():
+            connection = httplib.HTTPConnection(*server.server_address)
+            connection.request("GET", "/health")
+            response = connection.getresponse()
+            statuses = [(response.status, json.loads(response.read())["status"])]
+            connection.request("POST", "/method", jsoncodec.dumps({"account": "horns&hoofs"}))
+            response = connection.getresponse()
+            response.read()
+            statuses.append(response.status)
+            connection.close()
+            return statuses
+
+        try:
+            server.RequestHandlerClass.starting = True
+            self.assertEqual(get_statuses(), [(503, "starting"), 503])
+            connector = api.attach_store(server, config, wait_fd=wait_fd)
+            while server.RequestHandlerClass.starting:
+                time.sleep(0.001)
+            self.assertEqual(get_statuses(), [(200, "resetting"), 422])
+            os.close(release_fd)
+            release_fd = None
+            connector.join()
+            self.assertEqual(get_statuses(), [(200, "ok"), 422])
+            self.assertIn("store", api.STARTUP)
+            self.assertTrue(isinstance(server.RequestHandlerClass.store, MemoryStore.MemoryStore))
+        finally:
+            if release_fd is not None:
+                os.close(release_fd)
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            self.assertTrue(connector is not None and api.detach_store(server, connector))
+
+    def test_bulk_scores(self):
+        combinations = [dict(zip(batch_score.FIELDS, flags)) for flags in itertools.product((None, 1), repeat=6)]
+        columns = [[arguments[name] for arguments in combinations] for name in batch_score.FIELDS]
+        expected = [scoring.get_score(None, **arguments) for arguments in combinations]
+        self.assertEqual(list(scoring.get_scores(*columns)), expected)
+
+    @cases([0, 2])
+    def test_batch_score(self, processes):
+        lines = [
+            '{"id": 1, "phone": "79175002040", "email": "stupnikov@otus.ru"}',
+            '{"gender": 1, "birthday": "01.01.1990", "first_name": "a", "last_name": "b"}',
+            '{"phone": "89175002040", "email": "stupnikovotus.ru"}',
+            '[1, 2]',
+        ]
+        records = batch_score.read_jsonl(line + "\n" for line in lines * 3)
+        output = "".join(batch_score.score_chunks(batch_score.chunks(records, 5), processes))
+        scored = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual([line["line"] for line in scored], range(1, 13))
+        self.assertEqual(scored[0], {"line": 1, "id": 1, "score": 3.0})
+        self.assertEqual(scored[5]["score"], 2.0)
+        self.assertEqual(set(scored[6]["error"]), {"phone", "email"})
+        self.assertEqual(scored[11]["error"], "Invalid record format")
+
+    def test_result_cache(self):
+        calls = []
+        results = api.ResultCache(ttl=60, error_ttl=60)
+
+        def compute(result):
+            def run():
+                calls.append(result)
+                time.sleep(0.05)
+                return result
+            return run
+
+        threads = [threading.Thread(target=results.get, args=("key", compute(({"score": 3.0}, api.OK, {}))))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results.get("error", compute(({}, api.INVALID_REQUEST, {})))[1], api.INVALID_REQUEST)
+        self.assertEqual(results.get("error", compute(({}, api.OK, {})))[1], api.INVALID_REQUEST)
+        results.get("forbidden", compute(("Forbidden", api.FORBIDDEN, {})))
+        results.get("forbidden", compute(("Forbidden", api.FORBIDDEN, {})))
+        self.assertEqual(len(calls), 4)
+
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        self.set_valid_auth(request)
+        reordered = dict(request, arguments=dict(reversed(request["arguments"].items())))
+        self.assertEqual(api.ResultCache.get_key(request), api.ResultCache.get_key(reordered))
+        self.assertNotEqual(api.ResultCache.get_key(request), api.ResultCache.get_key(dict(request, token="")))
+        self.assertEqual(self.get_response(request), self.get_response(reordered))
+        self.assertEqual(self.store.cache_stats()["entries"], 1)
+        self.assertEqual(sorted(self.context["has"]), ["email", "phone"])
+        self.assertEqual(self.get_response(dict(request, token=""))[1], api.FORBIDDEN)
+
+        admin_request = dict(request, login=api.ADMIN_LOGIN, account="admin_account")
+        self.set_valid_auth(admin_request)
+        self.assertEqual(self.get_response(admin_request), ({"score": api.ADMIN_SCORE}, api.OK))
+        self.assertIsNone(self.store.cache_get("admin_account"))
+
+        interests_request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                             "arguments": {"client_ids": [1, 2]}}
+        self.set_valid_auth(interests_request)
+        entries = len(api.RESULT_CACHE.results)
+        self.assertEqual(self.get_response(interests_request)[1], api.OK)
+        self.assertEqual(len(api.RESULT_CACHE.results), entries)
+
+    def test_request_fields(self):
+        body = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "unknown": 1,
+                "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        request = api.OnlineScoreRequest.from_body(body)
+        self.assertFalse(hasattr(request, "__dict__"))
+        self.assertEqual((request.login, request.token, request.phone, request.gender), ("h&f", None, "79175002040",
+                                                                                          None))
+        self.assertRaises(AttributeError, setattr, request, "unknown", 1)
+        request.validate_self()
+        self.assertEqual(request.errors, {"token": "Mandatory parameter can't be omitted"})
+        self.assertIsNone(api.ClientsInterestsRequest(arguments=[1, 2]).client_ids)
+        self.assertEqual(api.process_method([body], {}, None)[1], api.INVALID_REQUEST)
+
 
 if __name__ == "__main__":
     unittest.main()